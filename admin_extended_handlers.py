@@ -1,22 +1,35 @@
 # admin_extended_handlers.py
 
-import asyncio
 import logging
+from datetime import datetime
+from typing import Optional
 
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery
-from sqlalchemy import select, delete, desc, asc, func
+from sqlalchemy import select, delete, desc, asc
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from admin_handlers import IsAdmin
-from database import Category, Review, User, MasterProfile, TattooWork, BotSettings, get_setting
-from keyboards import (get_admin_category_manage_kb, AdminMenuCallback,
+from database import Category, Review, User, MasterProfile, Payment, apply_review_rating_stmt
+from keyboards import (AdminMenuCallback,
                        AdminCategoryCallback, get_admin_main_kb, AdminReviewCallback,
                        get_admin_review_keyboard, get_admin_stats_kb,
                        AdminMailingCallback, get_admin_mailing_confirm_kb,
-                       AdminPaymentCallback, get_admin_payment_keyboard)  # Добавили импорты
+                       AdminPaymentCallback, get_admin_payment_keyboard,
+                       get_admin_settings_kb)  # Добавили импорты
 from states import AdminCategoryManagement, AdminReviewManagement, AdminMailing, AdminSettingsManagement
+from broadcast import create_broadcast, start_broadcast
+from crypto_api import crypto_api
+from settings_registry import runtime_settings
+from payments import (paid_payments_page_stmt, payment_cursor, parse_payment_cursor,
+                      PAYMENT_WORK, PAYMENT_MASTER_REG)
+from categories import get_catalog, invalidate_catalog
+from gallery import invalidate_gallery
+from stats import MarketStats, get_stats, refresh_stats
+
+PAYMENT_KINDS = {PAYMENT_WORK: 'Размещение работы', PAYMENT_MASTER_REG: 'Статус мастера'}
 
 router = Router()
 router.message.filter(IsAdmin())
@@ -43,10 +56,10 @@ async def section_in_development(query: CallbackQuery):
 
 @router.callback_query(AdminMenuCallback.filter(F.action == "category_management"))
 async def manage_categories(query: CallbackQuery, session: AsyncSession):
-    categories = await session.scalars(select(Category).order_by(Category.name))
+    catalog = await get_catalog(session)
     await query.message.edit_text(
         "Управление категориями (стилями) татуировок:",
-        reply_markup=get_admin_category_manage_kb(list(categories.all()))
+        reply_markup=catalog.admin_kb
     )
 
 
@@ -69,14 +82,15 @@ async def add_category_process(message: Message, state: FSMContext, session: Asy
     new_category = Category(name=new_category_name)
     session.add(new_category)
     await session.commit()
+    invalidate_catalog()
     await state.clear()
 
     await message.answer(f"✅ Категория '{new_category_name}' успешно добавлена.")
 
-    categories = await session.scalars(select(Category).order_by(Category.name))
+    catalog = await get_catalog(session)
     await message.answer(
         "Управление категориями (стилями) татуировок:",
-        reply_markup=get_admin_category_manage_kb(list(categories.all()))
+        reply_markup=catalog.admin_kb
     )
 
 
@@ -87,13 +101,16 @@ async def delete_category(query: CallbackQuery, callback_data: AdminCategoryCall
 
     await session.execute(delete(Category).where(Category.id == category_id))
     await session.commit()
+    invalidate_catalog()
+    # Название стиля показывается на карточках работ
+    invalidate_gallery()
 
     await query.answer(f"Категория '{category_name}' удалена.", show_alert=True)
 
-    categories = await session.scalars(select(Category).order_by(Category.name))
+    catalog = await get_catalog(session)
     await query.message.edit_text(
         "Управление категориями (стилями) татуировок:",
-        reply_markup=get_admin_category_manage_kb(list(categories.all()))
+        reply_markup=catalog.admin_kb
     )
 
 
@@ -149,9 +166,14 @@ async def paginate_reviews(query: CallbackQuery, callback_data: AdminReviewCallb
 
 @router.callback_query(AdminReviewCallback.filter(F.action == "delete"))
 async def delete_review(query: CallbackQuery, callback_data: AdminReviewCallback, session: AsyncSession):
-    review_id = callback_data.review_id
-    await session.execute(delete(Review).where(Review.id == review_id))
-    await session.commit()
+    review = await session.get(Review, callback_data.review_id)
+    if review:
+        master_id, rating = review.master_id, review.rating
+        result = await session.execute(delete(Review).where(Review.id == review.id))
+        # Отзыв мог уже удалить другой админ — тогда рейтинг повторно не трогаем
+        if result.rowcount:
+            await session.execute(apply_review_rating_stmt(master_id, rating, sign=-1))
+        await session.commit()
     await query.answer("Отзыв удален.", show_alert=True)
     await show_review_for_admin(query, session, direction='first')
 
@@ -198,35 +220,75 @@ async def process_review_reply(message: Message, state: FSMContext, session: Asy
 
 # --- СТАТИСТИКА ---
 
-@router.callback_query(AdminMenuCallback.filter(F.action == "statistics"))
-async def show_statistics(query: CallbackQuery, session: AsyncSession):
-    total_users = await session.scalar(select(func.count(User.id)))
-    total_masters = await session.scalar(select(func.count(User.id)).where(User.role == 'master'))
-    total_clients = await session.scalar(select(func.count(User.id)).where(User.role == 'client'))
-    total_works = await session.scalar(select(func.count(TattooWork.id)))
-    published_works = await session.scalar(select(func.count(TattooWork.id)).where(TattooWork.status == 'published'))
-    pending_works = await session.scalar(
-        select(func.count(TattooWork.id)).where(TattooWork.status == 'pending_approval'))
-    rejected_works = await session.scalar(select(func.count(TattooWork.id)).where(TattooWork.status == 'rejected'))
-    total_reviews = await session.scalar(select(func.count(Review.id)))
+def format_snapshot_age(seconds: int) -> str:
+    if seconds < 60:
+        return "только что"
+    if seconds < 3600:
+        return f"{seconds // 60} мин. назад"
+    return f"{seconds // 3600} ч. назад"
+
+
+CRYPTO_API_STATES = {'closed': '✅ доступен', 'open': '⛔️ недоступен', 'half_open': '⏳ проверка связи'}
+
+
+def format_crypto_api_health() -> str:
+    metrics = crypto_api.metrics()
+    lines = [f"💳 <b>Crypto Pay:</b> {CRYPTO_API_STATES[metrics['breaker']]}"]
+    for name, method in metrics['methods'].items():
+        lines.append(f"  - {name}: вызовов {method['calls']}, ошибок {method['failures']}, "
+                     f"p50 {method['p50_ms']} мс, p95 {method['p95_ms']} мс")
+    return "\n".join(lines)
+
+
+def format_revenue(stats: MarketStats) -> str:
+    if not stats.revenue:
+        return "  - Оплат пока нет"
+    lines = []
+    for asset, by_kind in stats.revenue.items():
+        details = ", ".join(f"{PAYMENT_KINDS.get(kind, kind).lower()}: {amount.normalize():f}"
+                            for kind, amount in by_kind.items())
+        lines.append(f"  - <b>{sum(by_kind.values()).normalize():f} {asset}</b> ({details})")
+    return "\n".join(lines)
+
+
+async def send_statistics(query: CallbackQuery, stats: MarketStats):
     stats_text = (
         "📊 <b>Статистика Маркетплейса</b>\n\n"
         "👥 <b>Пользователи:</b>\n"
-        f"  - Всего: <b>{total_users}</b>\n"
-        f"  - Мастеров: <b>{total_masters}</b>\n"
-        f"  - Клиентов: <b>{total_clients}</b>\n\n"
+        f"  - Всего: <b>{stats.total_users}</b>\n"
+        f"  - Мастеров: <b>{stats.users_by_role.get('master', 0)}</b>\n"
+        f"  - Клиентов: <b>{stats.users_by_role.get('client', 0)}</b>\n\n"
         "🎨 <b>Работы:</b>\n"
-        f"  - Всего загружено: <b>{total_works}</b>\n"
-        f"  - Опубликовано: <b>{published_works}</b>\n"
-        f"  - На модерации: <b>{pending_works}</b>\n"
-        f"  - Отклонено: <b>{rejected_works}</b>\n\n"
+        f"  - Всего загружено: <b>{stats.total_works}</b>\n"
+        f"  - Опубликовано: <b>{stats.works_by_status.get('published', 0)}</b>\n"
+        f"  - На модерации: <b>{stats.works_by_status.get('pending_approval', 0)}</b>\n"
+        f"  - Отклонено: <b>{stats.works_by_status.get('rejected', 0)}</b>\n\n"
         "⭐️ <b>Отзывы:</b>\n"
-        f"  - Всего оставлено: <b>{total_reviews}</b>"
+        f"  - Всего оставлено: <b>{stats.total_reviews}</b>\n\n"
+        "💰 <b>Выручка:</b>\n"
+        f"{format_revenue(stats)}\n\n"
+        f"{format_crypto_api_health()}\n\n"
+        f"<i>Обновлено: {stats.collected_at:%d.%m.%Y %H:%M} ({format_snapshot_age(stats.age_seconds)})</i>"
     )
-    await query.message.edit_text(stats_text, reply_markup=get_admin_stats_kb())
+    try:
+        await query.message.edit_text(stats_text, reply_markup=get_admin_stats_kb())
+    except TelegramBadRequest:
+        # Снимок не изменился с прошлого показа
+        pass
     await query.answer()
 
 
+@router.callback_query(AdminMenuCallback.filter(F.action == "statistics"))
+async def show_statistics(query: CallbackQuery, session: AsyncSession):
+    # Снимок считает фоновая задача (см. stats.py), здесь к БД обращаемся только до первого пересчета
+    await send_statistics(query, await get_stats(session))
+
+
+@router.callback_query(AdminMenuCallback.filter(F.action == "statistics_refresh"))
+async def refresh_statistics(query: CallbackQuery, session: AsyncSession):
+    await send_statistics(query, await refresh_stats(session))
+
+
 # --- РАССЫЛКА ---
 
 @router.callback_query(AdminMenuCallback.filter(F.action == "mailing"))
@@ -265,66 +327,43 @@ async def process_mailing(query: CallbackQuery, state: FSMContext, session: Asyn
     text = data.get("text")
     await state.clear()
     await query.message.edit_text("⏳ Начинаю рассылку...", reply_markup=None)
-    users_result = await session.execute(select(User.telegram_id))
-    user_ids = users_result.scalars().all()
-    successful_sends = 0
-    failed_sends = 0
-    for user_id in user_ids:
-        try:
-            await query.bot.send_message(chat_id=user_id, text=text, disable_web_page_preview=True)
-            successful_sends += 1
-        except Exception as e:
-            failed_sends += 1
-            logging.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-        await asyncio.sleep(0.1)
-    await query.message.answer(
-        "✅ <b>Рассылка завершена.</b>\n\n"
-        f"Успешно отправлено: <b>{successful_sends}</b>\n"
-        f"Ошибок: <b>{failed_sends}</b>"
-    )
+    # Рассылка идет в фоне (см. broadcast.py) и сама обновляет это сообщение прогрессом
+    job = await create_broadcast(session, text, admin_chat_id=query.message.chat.id,
+                                 progress_message_id=query.message.message_id)
+    start_broadcast(query.bot, job.id)
+    await query.answer()
 
 
 # --- НОВЫЙ БЛОК: УПРАВЛЕНИЕ ПЛАТЕЖАМИ ---
 
-async def get_payment_info_text(work: TattooWork, session: AsyncSession) -> str:
-    master_profile = await session.get(MasterProfile, work.master_id)
-    master_user = await session.get(User, master_profile.user_id)
-
+async def get_payment_info_text(payment: Payment, session: AsyncSession) -> str:
+    user = await session.get(User, payment.user_id)
+    work_line = f"<b>Работа ID:</b> {payment.work_id}\n" if payment.work_id else ""
     return (
-        f"🧾 <b>Платеж за работу #{work.id}</b>\n\n"
-        f"<b>Мастер:</b> @{master_user.username} (ID: <code>{master_user.telegram_id}</code>)\n"
-        f"<b>Invoice ID:</b> <code>{work.invoice_id}</code>\n"
-        f"<b>Сумма:</b> {int(work.price)} руб.\n"
-        f"<b>Дата:</b> {work.created_at.strftime('%Y-%m-%d %H:%M')}\n"
-        f"<b>Текущий статус работы:</b> {work.status}"
+        f"🧾 <b>Платеж #{payment.id}</b>\n\n"
+        f"<b>Назначение:</b> {PAYMENT_KINDS.get(payment.kind, payment.kind)}\n"
+        f"{work_line}"
+        f"<b>Плательщик:</b> @{user.username} (ID: <code>{user.telegram_id}</code>)\n"
+        f"<b>Invoice ID:</b> <code>{payment.invoice_id}</code>\n"
+        f"<b>Сумма:</b> {payment.amount.normalize():f} {payment.asset}\n"
+        f"<b>Счет выставлен:</b> {payment.created_at.strftime('%Y-%m-%d %H:%M')}\n"
+        f"<b>Оплачен:</b> {payment.paid_at.strftime('%Y-%m-%d %H:%M') if payment.paid_at else '—'}"
     )
 
 
-async def show_payment_for_admin(query: CallbackQuery, session: AsyncSession, work_id: int = None,
-                                 direction: str = 'first'):
-    stmt = None
-    paid_statuses = ['pending_approval', 'published', 'rejected']
+async def show_payment_for_admin(query: CallbackQuery, session: AsyncSession, direction: str = 'first',
+                                 cursor: Optional[tuple[datetime, int]] = None):
+    payment = await session.scalar(paid_payments_page_stmt(direction, cursor))
 
-    if direction == 'first':
-        stmt = select(TattooWork).where(TattooWork.status.in_(paid_statuses)).order_by(desc(TattooWork.id)).limit(1)
-    elif direction == 'next':
-        stmt = select(TattooWork).where(TattooWork.id < work_id, TattooWork.status.in_(paid_statuses)).order_by(
-            desc(TattooWork.id)).limit(1)
-    elif direction == 'prev':
-        stmt = select(TattooWork).where(TattooWork.id > work_id, TattooWork.status.in_(paid_statuses)).order_by(
-            asc(TattooWork.id)).limit(1)
-
-    work = await session.scalar(stmt)
-
-    if not work:
+    if not payment:
         if direction == 'first':
             await query.message.edit_text("Проведенных платежей пока нет.")
         else:
             await query.answer("Это крайний платеж в списке.", show_alert=True)
         return
 
-    text = await get_payment_info_text(work, session)
-    keyboard = get_admin_payment_keyboard(work.id)
+    text = await get_payment_info_text(payment, session)
+    keyboard = get_admin_payment_keyboard(payment.id, payment_cursor(payment))
     await query.message.edit_text(text, reply_markup=keyboard)
     await query.answer()
 
@@ -336,17 +375,21 @@ async def start_payment_management(query: CallbackQuery, session: AsyncSession):
 
 @router.callback_query(AdminPaymentCallback.filter(F.action.in_(['prev', 'next'])))
 async def paginate_payments(query: CallbackQuery, callback_data: AdminPaymentCallback, session: AsyncSession):
-    await show_payment_for_admin(query, session, work_id=callback_data.work_id, direction=callback_data.action)
+    if callback_data.payment_id is None or callback_data.created_at is None:
+        # Кнопка старого формата — начинаем с последнего платежа
+        await show_payment_for_admin(query, session, direction='first')
+        return
+    await show_payment_for_admin(query, session, direction=callback_data.action,
+                                 cursor=parse_payment_cursor(callback_data.created_at, callback_data.payment_id))
 
 
 # --- НОВЫЙ БЛОК: УПРАВЛЕНИЕ НАСТРОЙКАМИ ---
 
 @router.callback_query(AdminMenuCallback.filter(F.action == "settings"))
-async def show_settings(query: CallbackQuery, session: AsyncSession):
-    master_price = await get_setting(session, 'master_price', '0')
+async def show_settings(query: CallbackQuery):
     await query.message.edit_text(
         "⚙️ Настройки бота",
-        reply_markup=get_admin_settings_kb(master_price)
+        reply_markup=get_admin_settings_kb(runtime_settings.get('master_price'))
     )
 
 
@@ -364,22 +407,14 @@ async def process_new_master_price(message: Message, state: FSMContext, session:
         await message.answer("Пожалуйста, введите целое число.")
         return
 
-    new_price = message.text
-
-    setting = await session.get(BotSettings, 'master_price')
-    if setting:
-        setting.value = new_price
-    else:
-        session.add(BotSettings(key='master_price', value=new_price))
-
-    await session.commit()
+    new_price = int(message.text)
+    await runtime_settings.set(session, 'master_price', new_price)
     await state.clear()
 
     await message.answer(f"✅ Цена за статус мастера установлена: {new_price} USDT.")
 
     # Возвращаемся в меню настроек
-    master_price = await get_setting(session, 'master_price', '0')
     await message.answer(
         "⚙️ Настройки бота",
-        reply_markup=get_admin_settings_kb(master_price)
+        reply_markup=get_admin_settings_kb(new_price)
     )
@@ -1,16 +1,22 @@
 # --- file: admin_handlers.py ---
 
+import logging
+
 from aiogram import Router, F, types
 from aiogram.filters import Command, Filter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, delete
 
 from config import settings
 from database import TattooWork, MasterProfile, User, Category # Добавили Category
 from keyboards import AdminModerationCallback, get_admin_main_kb, get_admin_user_manage_kb, AdminUserActionCallback, AdminMenuCallback
 from states import AdminUserSearch
+from middlewares import invalidate_user
+from masters import invalidate_masters_count
+from gallery import invalidate_gallery
+from ranking import apply_work_scores
 
 router = Router()
 
@@ -97,6 +103,8 @@ async def block_unblock_user(query: CallbackQuery, callback_data: AdminUserActio
         action_text = "разблокирован"
 
     await session.commit()
+    invalidate_user(user_to_manage.telegram_id)
+    invalidate_masters_count()
     await query.answer(f"Мастер успешно {action_text}.")
 
     keyboard = get_admin_user_manage_kb(user_id=user_to_manage.id, is_active=master_profile.is_active)
@@ -117,6 +125,9 @@ async def block_unblock_user(query: CallbackQuery, callback_data: AdminUserActio
         action_text = "лишен статуса мастера"
 
         await session.commit()
+        invalidate_user(user_to_manage.telegram_id)
+        invalidate_masters_count()
+        invalidate_gallery()
         await query.answer("Пользователь лишен статуса мастера.", show_alert=True)
         await query.message.edit_text("Профиль пользователя обновлен. Он больше не является мастером.")
 
@@ -143,7 +154,9 @@ async def approve_work(query: CallbackQuery, callback_data: AdminModerationCallb
         await query.answer("Работа не найдена!", show_alert=True)
         return
     work.status = 'published'
+    apply_work_scores(work)
     await session.commit()
+    invalidate_gallery()
     await query.message.edit_caption(
         caption=query.message.caption + f"\n\n✅ Одобрено @{query.from_user.username}",
         reply_markup=None
@@ -168,6 +181,7 @@ async def reject_work(query: CallbackQuery, callback_data: AdminModerationCallba
         return
     work.status = 'rejected'
     await session.commit()
+    invalidate_gallery()
     await query.message.edit_caption(
         caption=query.message.caption + f"\n\n❌ Отклонено @{query.from_user.username}",
         reply_markup=None
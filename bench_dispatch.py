@@ -0,0 +1,159 @@
+# bench_dispatch.py
+#
+# Замер стоимости маршрутизации callback-запросов: обычный обход роутеров aiogram
+# против индекса префиксов (callback_index.py). Подключаются все роутеры бота, а хендлеры
+# подменяются пустыми функциями, поэтому в замер попадает только выбор хендлера.
+# Заодно проверяется, что оба способа выбирают один и тот же хендлер.
+#
+# Запуск: python bench_dispatch.py [--rounds N]
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+from callback_index import CallbackPrefixIndex
+from config import settings
+from keyboards import WorkPaginationCallback, RankedWorkPaginationCallback, WorkFilterCallback, WorkSortCallback
+from states import WorkSubmission, UserReviewing, AdminMailing
+
+from admin_handlers import router as admin_router
+from admin_extended_handlers import router as admin_extended_router
+from master_handlers import router as master_router
+from user_handlers import router as user_router
+
+ADMIN_ID = int(settings.admin_ids.split(',')[0])
+USER_ID = ADMIN_ID + 1
+# У каждого пользователя одно состояние FSM, поэтому для запросов с состоянием — отдельные пользователи
+MASTER_ID = ADMIN_ID + 2
+REVIEWER_ID = ADMIN_ID + 3
+
+# (пользователь, callback_data, состояние FSM) — по одному запросу на каждый вид кнопок
+SAMPLES: list[tuple[int, str, State | None]] = [
+    (USER_ID, WorkPaginationCallback(action="next", current_work_id=15).pack(), None),
+    (USER_ID, WorkPaginationCallback(action="prev", current_work_id=15, category_id=3).pack(), None),
+    (USER_ID, RankedWorkPaginationCallback(action="next", current_work_id=15, score=120_000,
+                                           sort="trending").pack(), None),
+    (USER_ID, "like:toggle:15", None),
+    (USER_ID, "comment:view:15", None),
+    (USER_ID, "comm_pag:next:15:2:20250101120000000000:40", None),
+    (USER_ID, "review:create:15", None),
+    (USER_ID, "master:view:4", None),
+    (USER_ID, WorkFilterCallback(action="select_style", category_id=2).pack(), None),
+    (USER_ID, WorkSortCallback(sort="popular").pack(), None),
+    (USER_ID, "master_pag:next:2:4.50:4:", None),
+    (USER_ID, "master_search:by_city", None),
+    (USER_ID, "payment:check_payment:15:1001", None),
+    (USER_ID, "payment:check_payment:0:1002", None),
+    (USER_ID, "my_works_pag:next:15", None),
+    (USER_ID, "master_edit:city", None),
+    (USER_ID, "show_my_profile", None),
+    (MASTER_ID, "style_3", WorkSubmission.waiting_for_style),
+    (REVIEWER_ID, "rating_5", UserReviewing.waiting_for_rating),
+    (ADMIN_ID, "admin_menu:statistics", None),
+    (ADMIN_ID, "admin_mod:approve:15", None),
+    (ADMIN_ID, "admin_user:block:7", None),
+    (ADMIN_ID, "admin_payment:next:3:20250101120000000000", None),
+    (ADMIN_ID, "admin_mail:send", AdminMailing.waiting_for_confirmation),
+    (ADMIN_ID, "set_master_price", None),
+]
+
+
+def build_dispatcher(hits: list[str]) -> Dispatcher:
+    dp = Dispatcher()
+    for router in (admin_router, admin_extended_router, master_router, user_router):
+        dp.include_router(router)
+
+    for router in dp.chain_tail:
+        for handler in router.callback_query.handlers:
+            name = f"{handler.callback.__module__}.{handler.callback.__name__}"
+
+            async def record(*args, _name=name, **kwargs):
+                hits.append(_name)
+
+            handler.callback = record
+            handler.__post_init__()
+    return dp
+
+
+def make_update(update_id: int, user_id: int, data: str) -> Update:
+    user = {"id": user_id, "is_bot": False, "first_name": "bench"}
+    return Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(datetime.now().timestamp()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": "bench",
+            },
+        },
+    })
+
+
+async def chosen_handlers(dp: Dispatcher, bot: Bot, updates: list[Update], hits: list[str]) -> list[str]:
+    """Какой хендлер выбран для каждого апдейта ('-' — апдейт не обработан)."""
+    chosen = []
+    for update in updates:
+        hits.clear()
+        await dp.feed_update(bot, update)
+        chosen.append(hits[0] if hits else '-')
+    hits.clear()
+    return chosen
+
+
+async def measure(dp: Dispatcher, bot: Bot, updates: list[Update], hits: list[str], rounds: int) -> list[float]:
+    """Среднее время обработки каждого апдейта в микросекундах."""
+    totals = [0.0] * len(updates)
+    for _ in range(rounds):
+        for i, update in enumerate(updates):
+            started = time.perf_counter()
+            await dp.feed_update(bot, update)
+            totals[i] += time.perf_counter() - started
+    hits.clear()
+    return [total / rounds * 1e6 for total in totals]
+
+
+async def main(rounds: int) -> None:
+    hits: list[str] = []
+    dp = build_dispatcher(hits)
+    bot = Bot(settings.bot_token.get_secret_value())
+
+    for user_id, _, state in SAMPLES:
+        if state is not None:
+            await dp.storage.set_state(StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id), state)
+    updates = [make_update(i, user_id, data) for i, (user_id, data, _) in enumerate(SAMPLES)]
+
+    linear_hits = await chosen_handlers(dp, bot, updates, hits)
+    linear = await measure(dp, bot, updates, hits, rounds)
+
+    dp.callback_query.outer_middleware(CallbackPrefixIndex(dp))
+    indexed_hits = await chosen_handlers(dp, bot, updates, hits)
+    indexed = await measure(dp, bot, updates, hits, rounds)
+
+    print(f"{'callback_data':<45} {'обход, мкс':>11} {'индекс, мкс':>12}  хендлер")
+    for (_, data, _), before, after, handler in zip(SAMPLES, linear, indexed, linear_hits):
+        print(f"{data[:45]:<45} {before:>11.1f} {after:>12.1f}  {handler}")
+    print(f"{'в среднем':<45} {sum(linear) / len(linear):>11.1f} {sum(indexed) / len(indexed):>12.1f}")
+
+    if linear_hits != indexed_hits:
+        mismatches = [(data, a, b) for (_, data, _), a, b in zip(SAMPLES, linear_hits, indexed_hits) if a != b]
+        raise SystemExit(f"Индекс выбрал другие хендлеры: {mismatches}")
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер маршрутизации callback-запросов")
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rounds))
@@ -0,0 +1,289 @@
+# broadcast.py
+#
+# Рассылка сообщения всем пользователям бота.
+#
+# Получатели читаются из БД порциями по users.id, внутри порции сообщения уходят параллельно,
+# но не быстрее settings.broadcast_rate в секунду на весь процесс. После каждой порции курсор
+# сохраняется в таблицу broadcasts, поэтому после перезапуска рассылка продолжается с места
+# остановки (повторно может уйти не больше одной порции).
+#
+# Через тот же ограничитель уходят уведомления админам (notify_admins): лимит Telegram
+# общий для всего бота.
+#
+# Воркеров бота может быть несколько, поэтому рассылку сначала захватывают (leases.py):
+# условный UPDATE записывает воркер владельцем, пока задание свободно или аренда истекла.
+# Владелец продлевает аренду, пока идет рассылка, и сохраняет прогресс только пока владеет
+# заданием. Каждый воркер раз в settings.broadcast_lease_ttl забирает рассылки с истекшей арендой.
+
+import asyncio
+import logging
+from datetime import timedelta
+from functools import partial
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from sqlalchemy import select, update, func, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database import async_session_factory, Broadcast, User, utcnow
+from leases import WORKER_ID
+from ratelimit import RateLimiter
+
+# Сколько раз повторять отправку одному пользователю после flood wait
+_MAX_ATTEMPTS = 3
+
+limiter = RateLimiter(settings.broadcast_rate)
+_tasks: dict[int, asyncio.Task] = {}
+_resumer: Optional[asyncio.Task] = None
+
+ADMIN_IDS = [int(i) for i in settings.admin_ids.split(',')]
+
+
+# --- ОТПРАВКА ---
+
+async def _deliver(chat_id: int, send: Callable[[], Awaitable]) -> bool:
+    """Выполняет send() под общим ограничителем, повторяя после flood wait. Ошибки не пробрасывает."""
+    for _ in range(_MAX_ATTEMPTS):
+        await limiter.acquire()
+        try:
+            await send()
+            return True
+        except TelegramRetryAfter as e:
+            # Лимит общий для всего бота — останавливаем всех отправителей
+            limiter.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота или удалил аккаунт — повторять бессмысленно
+            logging.info(f"Получатель {chat_id} недоступен: {e}")
+            return False
+        except Exception as e:
+            logging.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+            return False
+    return False
+
+
+async def _send(bot: Bot, chat_id: int, text: str) -> bool:
+    return await _deliver(chat_id, partial(bot.send_message, chat_id=chat_id, text=text,
+                                           disable_web_page_preview=True,
+                                           allow_paid_broadcast=settings.broadcast_paid))
+
+
+async def notify_admins(send: Callable[[int], Awaitable]) -> int:
+    """
+    Вызывает send(admin_id) для всех админов параллельно. Ошибка доставки одному админу
+    не мешает остальным. Возвращает число успешных отправок.
+    """
+    results = await asyncio.gather(*(_deliver(admin_id, partial(send, admin_id)) for admin_id in ADMIN_IDS))
+    return sum(results)
+
+
+async def _send_chunk(bot: Bot, chat_ids: list[int], text: str) -> tuple[int, int]:
+    """Отправляет сообщение порции получателей. Возвращает (успешно, ошибок)."""
+    semaphore = asyncio.Semaphore(settings.broadcast_concurrency)
+
+    async def send_one(chat_id: int) -> bool:
+        async with semaphore:
+            return await _send(bot, chat_id, text)
+
+    results = await asyncio.gather(*(send_one(chat_id) for chat_id in chat_ids))
+    sent = sum(results)
+    return sent, len(results) - sent
+
+
+# --- ПРОГРЕСС ---
+
+def _progress_text(job: Broadcast) -> str:
+    if job.status == 'finished':
+        return (
+            "✅ <b>Рассылка завершена.</b>\n\n"
+            f"Успешно отправлено: <b>{job.sent}</b>\n"
+            f"Ошибок: <b>{job.failed}</b>"
+        )
+    return (
+        "⏳ <b>Идет рассылка...</b>\n\n"
+        f"Обработано: <b>{job.sent + job.failed}</b> из ~{job.total}\n"
+        f"Успешно: <b>{job.sent}</b>, ошибок: <b>{job.failed}</b>"
+    )
+
+
+async def _report_progress(bot: Bot, job: Broadcast) -> None:
+    if not job.progress_message_id:
+        return
+    try:
+        await bot.edit_message_text(_progress_text(job), chat_id=job.admin_chat_id,
+                                    message_id=job.progress_message_id)
+    except TelegramBadRequest:
+        # Текст не изменился или сообщение удалено
+        pass
+
+
+# --- ЗАДАНИЕ ---
+
+async def create_broadcast(session: AsyncSession, text: str, admin_chat_id: int,
+                           progress_message_id: Optional[int] = None) -> Broadcast:
+    job = Broadcast(
+        text=text,
+        admin_chat_id=admin_chat_id,
+        progress_message_id=progress_message_id,
+        total=await session.scalar(select(func.count(User.id))),
+    )
+    session.add(job)
+    await session.commit()
+    return job
+
+
+def _claimable():
+    """Рассылка идет, и ее никто не ведет: владельца нет или он давно не продлевал аренду."""
+    stale = utcnow() - timedelta(seconds=settings.broadcast_lease_ttl)
+    return and_(Broadcast.status == 'running', or_(Broadcast.owner.is_(None), Broadcast.heartbeat_at < stale))
+
+
+def _owned_update(job_id: int):
+    """UPDATE задания, который сработает, только пока этот воркер им владеет."""
+    return (
+        update(Broadcast)
+        .where(Broadcast.id == job_id, Broadcast.owner == WORKER_ID)
+        .values(heartbeat_at=utcnow())
+    )
+
+
+async def _claim(session: AsyncSession, job_id: int) -> bool:
+    result = await session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == job_id, _claimable())
+        .values(owner=WORKER_ID, heartbeat_at=utcnow())
+    )
+    await session.commit()
+    return result.rowcount == 1
+
+
+async def _keep_lease(job_id: int) -> None:
+    """Продлевает аренду, пока идет рассылка. Завершается, если задание перехватил другой воркер."""
+    while True:
+        await asyncio.sleep(settings.broadcast_lease_ttl / 3)
+        async with async_session_factory() as session:
+            result = await session.execute(_owned_update(job_id))
+            await session.commit()
+        if result.rowcount != 1:
+            logging.warning(f"Рассылку #{job_id} перехватил другой воркер")
+            return
+
+
+async def run_broadcast(bot: Bot, job_id: int) -> None:
+    async with async_session_factory() as session:
+        if not await _claim(session, job_id):
+            # Рассылка завершена или ее ведет другой воркер
+            return
+        job = await session.get(Broadcast, job_id)
+        # Дальше job — только копия для подсчета прогресса: в БД пишет условный UPDATE владельца
+        session.expunge(job)
+
+        heartbeat = asyncio.create_task(_keep_lease(job_id))
+        try:
+            loop = asyncio.get_running_loop()
+            last_report = loop.time()
+            while True:
+                recipients = (await session.execute(
+                    select(User.id, User.telegram_id)
+                    .where(User.id > job.last_user_id)
+                    .order_by(User.id)
+                    .limit(settings.broadcast_chunk_size)
+                )).all()
+                if not recipients:
+                    break
+
+                sent, failed = await _send_chunk(bot, [r.telegram_id for r in recipients], job.text)
+                job.last_user_id = recipients[-1].id
+                job.sent += sent
+                job.failed += failed
+                result = await session.execute(
+                    _owned_update(job_id).values(last_user_id=job.last_user_id, sent=job.sent, failed=job.failed)
+                )
+                await session.commit()
+                if result.rowcount != 1:
+                    logging.warning(f"Рассылка #{job_id} остановлена: задание перехватил другой воркер")
+                    return
+
+                if loop.time() - last_report >= settings.broadcast_progress_interval:
+                    await _report_progress(bot, job)
+                    last_report = loop.time()
+
+            job.status = 'finished'
+            job.finished_at = utcnow()
+            result = await session.execute(
+                _owned_update(job_id).values(status=job.status, finished_at=job.finished_at)
+            )
+            await session.commit()
+            if result.rowcount != 1:
+                return
+        finally:
+            heartbeat.cancel()
+
+    await _report_progress(bot, job)
+    try:
+        await bot.send_message(job.admin_chat_id, _progress_text(job))
+    except Exception as e:
+        logging.error(f"Не удалось отправить итог рассылки #{job.id}: {e}")
+
+
+async def _run_logged(bot: Bot, job_id: int) -> None:
+    try:
+        await run_broadcast(bot, job_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Задание остается в статусе 'running' и продолжится при следующем запуске
+        logging.exception(f"Рассылка #{job_id} прервана")
+
+
+def start_broadcast(bot: Bot, job_id: int) -> asyncio.Task:
+    task = asyncio.create_task(_run_logged(bot, job_id))
+    _tasks[job_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(job_id, None))
+    return task
+
+
+# --- ЗАПУСК И ОСТАНОВКА БОТА ---
+
+async def _resume_stale(bot: Bot) -> None:
+    """Запускает рассылки, которые никто не ведет: прерванные остановкой бота или пропавшим воркером."""
+    async with async_session_factory() as session:
+        job_ids = (await session.scalars(select(Broadcast.id).where(_claimable()))).all()
+    for job_id in job_ids:
+        if job_id not in _tasks:
+            logging.info(f"Продолжаю рассылку #{job_id}")
+            start_broadcast(bot, job_id)
+
+
+async def _resume_loop(bot: Bot) -> None:
+    while True:
+        try:
+            await _resume_stale(bot)
+        except Exception:
+            logging.exception("Не удалось проверить прерванные рассылки")
+        await asyncio.sleep(settings.broadcast_lease_ttl)
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    global _resumer
+    _resumer = asyncio.create_task(_resume_loop(bot))
+
+
+async def stop_broadcasts() -> None:
+    global _resumer
+    tasks = list(_tasks.values())
+    if _resumer:
+        tasks.append(_resumer)
+        _resumer = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Отпускаем аренду, чтобы рассылки сразу продолжил другой воркер или этот же после перезапуска
+    async with async_session_factory() as session:
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.owner == WORKER_ID, Broadcast.status == 'running')
+            .values(owner=None, heartbeat_at=None)
+        )
+        await session.commit()
@@ -0,0 +1,55 @@
+# cache.py
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+_DEFAULT_TTL: Any = object()
+
+
+class TTLCache:
+    """
+    Простой in-memory кэш с временем жизни записей и ограничением размера (LRU).
+
+    ttl=None означает, что запись живет, пока ее не вытеснят или не инвалидируют.
+    """
+
+    def __init__(self, ttl: Optional[float], maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[Optional[float], Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not None
+
+    def _lookup(self, key: Hashable) -> Optional[tuple[Optional[float], Any]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, _ = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._lookup(key)
+        return item[1] if item is not None else default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = _DEFAULT_TTL) -> None:
+        ttl = self.ttl if ttl is _DEFAULT_TTL else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
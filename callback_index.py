@@ -0,0 +1,169 @@
+# callback_index.py
+#
+# Маршрутизация callback-запросов по префиксу callback_data.
+#
+# Обычно aiogram обходит роутеры по очереди (admin, admin_extended, master, user): у каждого выполняет
+# фильтры роутера (IsAdmin) и пробует фильтры всех его хендлеров. Индекс строится один раз после
+# подключения роутеров и по префиксу ("work_pag", "like", "admin_mod", ...) сразу отдает хендлеры,
+# которые могут принять такой запрос, в исходном порядке. Фильтры этих хендлеров и их роутеров
+# проверяются как обычно, поэтому выбирается тот же хендлер, что и при полном обходе.
+
+import operator
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Dispatcher, Router, F
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.filters.callback_data import CallbackQueryFilter
+from aiogram.types import CallbackQuery
+from magic_filter import MagicFilter
+from magic_filter.operations import GetAttributeOperation, ComparatorOperation, CallOperation
+
+
+def callback_key(data: str) -> str:
+    """Префикс callback_data: для CallbackData — его prefix, для простых строк — вся строка до двоеточия."""
+    return data.split(':', 1)[0]
+
+
+@dataclass(frozen=True)
+class _Entry:
+    order: int
+    router: Router
+    handler: HandlerObject
+
+
+def _magic_rule(magic: MagicFilter) -> Optional[tuple[str, str]]:
+    """
+    Распознает F.data == "..." и F.data.startswith("...") по цепочке операций magic_filter.
+    Это приватный атрибут библиотеки, поэтому его вид проверяет _check_magic_filter_layout.
+    """
+    ops = getattr(magic, '_operations', None)
+    if not isinstance(ops, tuple):
+        raise RuntimeError("magic_filter.MagicFilter больше не хранит цепочку в _operations, "
+                           "индекс префиксов нужно обновить под новую версию magic_filter")
+    if not (ops and isinstance(ops[0], GetAttributeOperation) and ops[0].name == 'data'):
+        return None
+    if (len(ops) == 2 and isinstance(ops[1], ComparatorOperation)
+            and ops[1].comparator is operator.eq and isinstance(ops[1].right, str)):
+        return 'exact', callback_key(ops[1].right)
+    if (len(ops) == 3 and isinstance(ops[1], GetAttributeOperation) and ops[1].name == 'startswith'
+            and isinstance(ops[2], CallOperation) and len(ops[2].args) == 1 and not ops[2].kwargs
+            and isinstance(ops[2].args[0], str) and ':' not in ops[2].args[0]):
+        return 'startswith', ops[2].args[0]
+    return None
+
+
+def _check_magic_filter_layout() -> None:
+    """
+    Без этой проверки смена внутреннего устройства magic_filter молча перевела бы все хендлеры
+    с F.data в _any: индекс продолжил бы работать, но без ускорения.
+    """
+    probes = (
+        (F.data == "probe", ('exact', 'probe')),
+        (F.data.startswith("probe"), ('startswith', 'probe')),
+    )
+    for magic, expected in probes:
+        if _magic_rule(magic) != expected:
+            raise RuntimeError(f"magic_filter изменил вид цепочки операций ({expected[0]} не распознан), "
+                               "индекс префиксов нужно обновить под новую версию magic_filter")
+
+
+def _handler_rule(handler: HandlerObject) -> tuple[str, Optional[str]]:
+    """
+    Какие callback_data может принять хендлер: ('exact', ключ), ('startswith', начало строки)
+    или ('any', None), если по фильтрам этого не понять.
+    """
+    for filter_object in handler.filters or ():
+        if isinstance(filter_object.callback, CallbackQueryFilter):
+            return 'exact', filter_object.callback.callback_data.__prefix__
+        if filter_object.magic is None:
+            continue
+        rule = _magic_rule(filter_object.magic)
+        if rule is not None:
+            return rule
+    return 'any', None
+
+
+class CallbackPrefixIndex(BaseMiddleware):
+    """
+    Outer-middleware для dp.callback_query. Создается после include_router всех роутеров:
+    хендлеры, добавленные позже, в индекс не попадут.
+    """
+
+    def __init__(self, dispatcher: Dispatcher):
+        _check_magic_filter_layout()
+        exact: dict[str, list[_Entry]] = {}
+        self._startswith: list[tuple[str, _Entry]] = []
+        self._any: list[_Entry] = []
+
+        order = 0
+        for router in dispatcher.chain_tail:
+            observer = router.callback_query
+            # Индекс вызывает хендлеры напрямую, минуя middleware роутеров
+            if len(observer.middleware) or (router is not dispatcher and len(observer.outer_middleware)):
+                raise RuntimeError(f"Роутер {router.name} использует middleware для callback_query, "
+                                   "индекс префиксов с ними не совместим")
+            for handler in observer.handlers:
+                entry = _Entry(order, router, handler)
+                order += 1
+                kind, key = _handler_rule(handler)
+                if kind == 'exact':
+                    exact.setdefault(key, []).append(entry)
+                elif kind == 'startswith':
+                    self._startswith.append((key, entry))
+                else:
+                    self._any.append(entry)
+
+        self._buckets = {key: self._collect(key, entries) for key, entries in exact.items()}
+
+    def _collect(self, key: str, entries: list[_Entry]) -> tuple[_Entry, ...]:
+        matched = entries + [entry for prefix, entry in self._startswith if key.startswith(prefix)] + self._any
+        return tuple(sorted(matched, key=lambda entry: entry.order))
+
+    def candidates(self, data: str) -> tuple[_Entry, ...]:
+        key = callback_key(data)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # Строки вида "style_3" не кэшируем: их значений неограниченно много
+            bucket = self._collect(key, [])
+        return bucket
+
+    async def _check_router(self, router: Router, event: CallbackQuery, data: Dict[str, Any],
+                            checked: dict[Router, tuple[bool, Dict[str, Any]]]) -> tuple[bool, Dict[str, Any]]:
+        """Фильтры роутера и всех его родителей — как при обычном обходе дерева роутеров."""
+        if router in checked:
+            return checked[router]
+        parent = router.parent_router
+        passed, router_data = (True, data) if parent is None else await self._check_router(parent, event, data,
+                                                                                            checked)
+        if passed:
+            passed, router_data = await router.callback_query.check_root_filters(
+                event, **{**router_data, 'event_router': router}
+            )
+        checked[router] = (passed, router_data)
+        return passed, router_data
+
+    async def __call__(
+        self,
+        handler: Callable[[CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: Dict[str, Any],
+    ) -> Any:
+        if event.data is None:
+            # Кнопки игр приходят без data — их разбирает обычный обход
+            return await handler(event, data)
+
+        checked: dict[Router, tuple[bool, Dict[str, Any]]] = {}
+        for entry in self.candidates(event.data):
+            passed, router_data = await self._check_router(entry.router, event, data, checked)
+            if not passed:
+                continue
+            passed, handler_data = await entry.handler.check(event, **{**router_data, 'handler': entry.handler})
+            if not passed:
+                continue
+            try:
+                return await entry.handler.call(event, **handler_data)
+            except SkipHandler:
+                continue
+        return UNHANDLED
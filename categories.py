@@ -0,0 +1,50 @@
+# categories.py
+#
+# Каталог стилей (таблица categories) в памяти. Таблица крошечная и меняется только из админки,
+# поэтому читается целиком, а клавиатуры со списком стилей собираются один раз на весь каталог.
+
+from dataclasses import dataclass
+from typing import Optional
+
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from config import settings
+from database import Category
+from keyboards import get_category_filter_kb, get_style_choice_kb, get_admin_category_manage_kb
+
+
+@dataclass(frozen=True)
+class CategoryCatalog:
+    # id -> название, в порядке сортировки по названию
+    names: dict[int, str]
+    filter_kb: InlineKeyboardMarkup
+    style_choice_kb: InlineKeyboardMarkup
+    admin_kb: InlineKeyboardMarkup
+
+    def name(self, category_id: Optional[int]) -> Optional[str]:
+        return self.names.get(category_id)
+
+
+_catalog_cache = TTLCache(ttl=settings.category_cache_ttl, maxsize=1)
+
+
+def invalidate_catalog() -> None:
+    """Вызывается после добавления и удаления категорий."""
+    _catalog_cache.clear()
+
+
+async def get_catalog(session: AsyncSession) -> CategoryCatalog:
+    catalog = _catalog_cache.get('catalog')
+    if catalog is None:
+        rows = (await session.execute(select(Category.id, Category.name).order_by(Category.name))).all()
+        catalog = CategoryCatalog(
+            names={row.id: row.name for row in rows},
+            filter_kb=get_category_filter_kb(rows),
+            style_choice_kb=get_style_choice_kb(rows),
+            admin_kb=get_admin_category_manage_kb(rows),
+        )
+        _catalog_cache.set('catalog', catalog)
+    return catalog
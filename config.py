@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import SecretStr
 
@@ -12,6 +14,91 @@ class Settings(BaseSettings):
     admin_ids: str
 
     crypto_api_token: SecretStr
+    crypto_api_base_url: str = 'https://pay.crypt.bot/api'
+    # Таймаут одной попытки запроса к Crypto Pay и размер пула соединений
+    crypto_api_timeout: float = 10.0
+    crypto_api_pool_size: int = 20
+    # Предельное время всего вызова вместе с повторами и число попыток
+    crypto_api_deadline: float = 20.0
+    crypto_api_max_attempts: int = 3
+    # Предохранитель: после стольких ошибок подряд запросы отклоняются сразу на reset_timeout секунд
+    crypto_api_breaker_threshold: int = 5
+    crypto_api_breaker_reset_timeout: float = 30.0
+    # Сколько секунд считать актуальным статус неоплаченного счета (оплаченные кэшируются бессрочно)
+    crypto_api_invoice_cache_ttl: float = 5.0
+    # Сколько секунд выставленный счет можно оплатить (expires_in в createInvoice)
+    crypto_invoice_ttl: int = 60 * 60
+    # Как часто (в секундах) фоново сверять неоплаченные счета работ
+    payment_reconcile_interval: int = 60
+    # Путь для вебхуков Crypto Pay (адрес указывается в настройках приложения в @CryptoBot).
+    # None — вебхук не принимается, оплата подтверждается кнопкой и фоновой сверкой.
+    # В режиме polling для него поднимается отдельный веб-сервер на web_server_host:web_server_port.
+    crypto_pay_webhook_path: Optional[str] = None
+
+    # --- ХРАНИЛИЩЕ FSM ---
+    # 'memory' — состояния живут в памяти одного процесса,
+    # 'redis' — общее хранилище для нескольких воркеров бота.
+    fsm_storage: str = 'memory'
+    redis_dsn: str = 'redis://localhost:6379/0'
+    redis_max_connections: int = 20
+    # Время жизни ключей FSM в секундах (None — без ограничения)
+    fsm_state_ttl: Optional[int] = 60 * 60 * 24
+    fsm_data_ttl: Optional[int] = 60 * 60 * 24
+
+    # --- ПОЛУЧЕНИЕ АПДЕЙТОВ ---
+    # 'polling' — long polling, 'webhook' — aiohttp-сервер за балансировщиком
+    run_mode: str = 'polling'
+    webhook_base_url: Optional[str] = None
+    webhook_path: str = '/webhook'
+    webhook_secret: Optional[SecretStr] = None
+    # Вебхук регистрирует только один инстанс, остальные просто принимают апдейты
+    webhook_set_on_startup: bool = True
+    # Сколько соединений Telegram может держать к нашему серверу (1-100)
+    webhook_max_connections: int = 40
+    web_server_host: str = '0.0.0.0'
+    web_server_port: int = 8080
+    # Максимум апдейтов, обрабатываемых одновременно одним инстансом
+    webhook_max_concurrency: int = 100
+    # Сколько секунд ждать свободный слот, прежде чем ответить Telegram 503
+    webhook_acquire_timeout: float = 2.0
+
+    # --- КЭШ ПОЛЬЗОВАТЕЛЕЙ ---
+    # Сколько секунд можно использовать загруженного пользователя без запроса к БД.
+    # Изменения, сделанные другим воркером, станут видны не позже чем через это время.
+    user_cache_ttl: int = 60
+    user_cache_size: int = 50_000
+
+    # --- ГАЛЕРЕЯ ---
+    # Сколько карточек с каждой стороны от текущей подгружать заранее при листании галереи
+    gallery_prefetch_size: int = 5
+    # Сколько секунд окно карточек остается актуальным (настолько могут отставать счетчики
+    # лайков и комментариев чужих действий) и для скольких пользователей оно хранится
+    gallery_prefetch_ttl: int = 60
+    gallery_prefetch_users: int = 10_000
+
+    # --- КАТАЛОГ СТИЛЕЙ ---
+    # Сколько секунд держать в памяти список категорий. Воркер, в котором админ изменил
+    # категории, сбрасывает его сразу, остальные увидят изменения не позже чем через это время.
+    category_cache_ttl: int = 300
+
+    # --- СТАТИСТИКА ---
+    # Как часто (в секундах) пересчитывать снимок статистики для админ-панели
+    stats_refresh_interval: int = 300
+
+    # --- РАССЫЛКА ---
+    # Telegram пропускает около 30 сообщений в секунду на бота. С broadcast_paid=True
+    # (allow_paid_broadcast, оплачивается Telegram Stars) лимит поднимается до 1000.
+    broadcast_rate: float = 25
+    broadcast_paid: bool = False
+    # Сколько сообщений одновременно ожидают ответа Telegram
+    broadcast_concurrency: int = 50
+    # Сколько получателей читать из БД за раз; курсор рассылки сохраняется после каждой порции
+    broadcast_chunk_size: int = 500
+    # Как часто (в секундах) обновлять сообщение с прогрессом у админа
+    broadcast_progress_interval: float = 5.0
+    # Рассылку ведет один воркер, продлевая аренду каждые broadcast_lease_ttl / 3 секунд.
+    # Если воркер пропал, рассылку через это время подхватит другой
+    broadcast_lease_ttl: int = 60
 
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
@@ -1,35 +1,294 @@
-import aiohttp
+import asyncio
+import hashlib
+import hmac
+import logging
+import random
+import time
+from collections import deque
+from math import ceil
 from typing import Optional
 
+import aiohttp
+
+from cache import TTLCache
+from config import settings
+
+
+class CryptoAPIUnavailable(Exception):
+    """Crypto Pay недоступен, предохранитель разомкнут. Текст исключения можно показывать пользователю."""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"⚠️ Платежный сервис временно недоступен. Попробуйте через {ceil(retry_after)} сек.")
+
+
+def verify_webhook_signature(token: str, body: bytes, signature: str) -> bool:
+    """Проверяет подпись вебхука Crypto Pay: HMAC-SHA256 тела запроса с ключом SHA256(токен)."""
+    secret = hashlib.sha256(token.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        self.status = status
+        # Пауза из заголовка Retry-After ответа 429, если сервер ее указал
+        self.retry_after = retry_after
+        super().__init__(f"HTTP {status}")
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах. HTTP-дату не разбираем — тогда обычная пауза с джиттером."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold ошибок подряд размыкается и reset_timeout секунд
+    сразу отклоняет запросы. Затем пропускает один пробный запрос: успех замыкает цепь,
+    ошибка снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'  # 'closed', 'open', 'half_open'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def check(self):
+        """Пропускает запрос или бросает CryptoAPIUnavailable."""
+        if self.state == 'open':
+            wait = self._opened_at + self.reset_timeout - time.monotonic()
+            if wait > 0:
+                raise CryptoAPIUnavailable(wait)
+            self.state = 'half_open'
+            self._trial_in_flight = False
+        if self.state == 'half_open':
+            if self._trial_in_flight:
+                raise CryptoAPIUnavailable(self.reset_timeout)
+            self._trial_in_flight = True
+
+    def record_success(self):
+        if self.state != 'closed':
+            logging.info("Crypto Pay снова доступен, предохранитель замкнут")
+        self.state = 'closed'
+        self._failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == 'half_open' or self._failures >= self.failure_threshold:
+            if self.state != 'open':
+                logging.warning(f"Crypto Pay недоступен, предохранитель разомкнут на {self.reset_timeout} сек.")
+            self.state = 'open'
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self):
+        """Пробный запрос отменен, не дойдя до результата."""
+        self._trial_in_flight = False
+
+
+class CallStats:
+    """Счетчики и задержки последних window вызовов одного метода API."""
+
+    def __init__(self, window: int = 200):
+        self.calls = 0
+        self.failures = 0
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float, ok: bool):
+        self.calls += 1
+        self.failures += not ok
+        self.latencies.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
 class CryptoAPI:
-    def __init__(self, token: str):
-        self.base_url = "https://pay.crypt.bot/api"
+    """
+    Клиент Crypto Pay API.
+
+    Все запросы идут через одну aiohttp-сессию с пулом keep-alive соединений,
+    поэтому TCP+TLS рукопожатие выполняется один раз, а не на каждый платеж.
+    Сессия открывается в start() при запуске бота и закрывается в close() при остановке.
+
+    Идемпотентные запросы повторяются до max_attempts раз с экспоненциальной задержкой и джиттером,
+    createInvoice — только если соединение не удалось установить. Весь вызов вместе с повторами
+    укладывается в deadline секунд. Пока предохранитель разомкнут, методы бросают CryptoAPIUnavailable.
+
+    Статусы счетов кэшируются на invoice_cache_ttl секунд, оплаченные — бессрочно. Одинаковые
+    одновременные запросы getInvoices объединяются в один вызов API.
+    """
+
+    def __init__(self, token: str, base_url: str = "https://pay.crypt.bot/api", timeout: float = 10.0,
+                 pool_size: int = 20, deadline: float = 20.0, max_attempts: int = 3, backoff: float = 0.5,
+                 breaker: Optional[CircuitBreaker] = None, invoice_cache_ttl: float = 5.0,
+                 invoice_expires_in: Optional[int] = None):
+        self.base_url = base_url
         self.headers = {"Crypto-Pay-API-Token": token}
+        self._timeout = timeout
+        self._pool_size = pool_size
+        self._deadline = deadline
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.stats: dict[str, CallStats] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._invoices = TTLCache(ttl=invoice_cache_ttl, maxsize=10_000)
+        self._invoices_in_flight: dict[tuple[int, ...], asyncio.Future] = {}
+        self.invoice_expires_in = invoice_expires_in
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Сессия создается и при первом запросе — на случай вызова вне жизненного цикла бота
+        await self.start()
+        return self._session
+
+    def metrics(self) -> dict:
+        """Состояние предохранителя и задержки по методам (в мс) для мониторинга."""
+        return {
+            "breaker": self.breaker.state,
+            "methods": {
+                name: {
+                    "calls": stats.calls,
+                    "failures": stats.failures,
+                    "p50_ms": round(stats.percentile(0.5) * 1000) if stats.latencies else None,
+                    "p95_ms": round(stats.percentile(0.95) * 1000) if stats.latencies else None,
+                }
+                for name, stats in self.stats.items()
+            },
+        }
 
-    async def get_me(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.base_url}/getMe", headers=self.headers) as response:
-                return await response.json()
+    async def _request(self, http_method: str, api_method: str, idempotent: bool, **kwargs) -> Optional[dict]:
+        """Выполняет запрос с повторами. Возвращает result из ответа или None, если запрос не удался."""
+        stats = self.stats.setdefault(api_method, CallStats())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._deadline
 
-    async def create_invoice(self, asset: str, amount: float) -> Optional[dict]:
-        payload = {
+        for attempt in range(1, self._max_attempts + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.breaker.check()
+
+            started = loop.time()
+            try:
+                session = await self._get_session()
+                timeout = aiohttp.ClientTimeout(total=min(self._timeout, remaining))
+                async with session.request(http_method, f"{self.base_url}/{api_method}", timeout=timeout,
+                                           **kwargs) as response:
+                    if response.status == 429:
+                        raise _RetryableStatus(429, _parse_retry_after(response.headers.get("Retry-After")))
+                    if response.status >= 500:
+                        raise _RetryableStatus(response.status)
+                    data = await response.json(content_type=None)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, _RetryableStatus, ValueError) as e:
+                stats.record(loop.time() - started, ok=False)
+                self.breaker.record_failure()
+                logging.warning(f"Crypto Pay {api_method}: попытка {attempt} не удалась: {e!r}")
+                # Неидемпотентный запрос повторяем, только если он точно не дошел до сервера
+                if not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                    break
+                if attempt < self._max_attempts:
+                    if isinstance(e, _RetryableStatus) and e.retry_after is not None:
+                        # Сервер сам сказал, сколько ждать, — как с flood wait в рассылке
+                        delay = e.retry_after
+                    else:
+                        delay = random.uniform(0, self._backoff * 2 ** (attempt - 1))
+                    await asyncio.sleep(min(delay, max(0.0, deadline - loop.time())))
+                continue
+
+            stats.record(loop.time() - started, ok=True)
+            self.breaker.record_success()
+            if response.status == 200 and data.get("ok"):
+                return data.get("result")
+            logging.error(f"Crypto Pay {api_method} вернул ошибку {response.status}: {data.get('error')}")
+            return None
+        return None
+
+    async def get_me(self) -> Optional[dict]:
+        return await self._request("GET", "getMe", idempotent=True)
+
+    async def create_invoice(self, asset: str, amount: float, payload: Optional[str] = None) -> Optional[dict]:
+        body = {
             "asset": asset,
             "amount": amount,
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/createInvoice", headers=self.headers, json=payload) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get("result")
-                return None
+        if payload:
+            # Произвольная строка, которую Crypto Pay вернет в вебхуке об оплате
+            body["payload"] = payload
+        if self.invoice_expires_in:
+            # Брошенный счет истечет, и фоновая сверка перестанет его проверять
+            body["expires_in"] = self.invoice_expires_in
+        return await self._request("POST", "createInvoice", idempotent=False, json=body)
+
+    def cache_invoice(self, invoice: dict):
+        # Оплаченный счет уже не изменится, его можно хранить бессрочно
+        ttl = None if invoice.get('status') == 'paid' else self._invoices.ttl
+        self._invoices.set(invoice['invoice_id'], invoice, ttl=ttl)
+
+    async def _fetch_invoices(self, invoice_ids: tuple[int, ...]) -> Optional[dict]:
+        """getInvoices без кэша; параллельные вызовы с теми же invoice_ids ждут один общий запрос."""
+        future = self._invoices_in_flight.get(invoice_ids)
+        if future is None:
+            params = {
+                "invoice_ids": ",".join(map(str, invoice_ids)),
+                # По умолчанию API отдает только 100 счетов
+                "count": len(invoice_ids),
+            }
+            future = asyncio.ensure_future(self._request("GET", "getInvoices", idempotent=True, params=params))
+            self._invoices_in_flight[invoice_ids] = future
+            future.add_done_callback(lambda _: self._invoices_in_flight.pop(invoice_ids, None))
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(future)
 
     async def get_invoices(self, invoice_ids: list[int]) -> Optional[dict]:
-        params = {
-            "invoice_ids": ",".join(map(str, invoice_ids))
-        }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.base_url}/getInvoices", headers=self.headers, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get("result")
-                return None
\ No newline at end of file
+        cached = {invoice_id: self._invoices.get(invoice_id) for invoice_id in invoice_ids}
+        missing = tuple(sorted(invoice_id for invoice_id, invoice in cached.items() if invoice is None))
+        if missing:
+            result = await self._fetch_invoices(missing)
+            if result is None:
+                return None
+            for invoice in result.get('items', []):
+                self.cache_invoice(invoice)
+                cached[invoice['invoice_id']] = invoice
+        return {"items": [cached[invoice_id] for invoice_id in invoice_ids if cached[invoice_id] is not None]}
+
+
+# Единственный экземпляр на процесс, общий для всех роутеров
+crypto_api = CryptoAPI(
+    token=settings.crypto_api_token.get_secret_value(),
+    base_url=settings.crypto_api_base_url,
+    timeout=settings.crypto_api_timeout,
+    pool_size=settings.crypto_api_pool_size,
+    deadline=settings.crypto_api_deadline,
+    max_attempts=settings.crypto_api_max_attempts,
+    breaker=CircuitBreaker(
+        failure_threshold=settings.crypto_api_breaker_threshold,
+        reset_timeout=settings.crypto_api_breaker_reset_timeout,
+    ),
+    invoice_cache_ttl=settings.crypto_api_invoice_cache_ttl,
+    invoice_expires_in=settings.crypto_invoice_ttl,
+)
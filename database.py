@@ -1,11 +1,12 @@
 # database.py
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy import (BigInteger, String, Text, ForeignKey, Integer, DECIMAL,
-                        JSON as SA_JSON, DateTime, func, PrimaryKeyConstraint)
+                        JSON as SA_JSON, DateTime, func, PrimaryKeyConstraint, Index, select, update, case)
 from typing import List
-from datetime import datetime
+from datetime import datetime, timezone
+from decimal import Decimal
 
 from config import settings
 
@@ -14,6 +15,11 @@ engine = create_async_engine(settings.db_dsn, echo=True)
 async_session_factory = async_sessionmaker(engine, expire_on_commit=False)
 
 
+def utcnow() -> datetime:
+    """Текущее время в UTC без часового пояса — в том же виде, в каком пишет func.now() SQLite."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class Base(DeclarativeBase):
     pass
 
@@ -37,9 +43,17 @@ class MasterProfile(Base):
     social_links: Mapped[List[dict]] = mapped_column(SA_JSON, nullable=True)
     is_active: Mapped[bool] = mapped_column(default=True)
     rating: Mapped[float] = mapped_column(DECIMAL(3, 2), nullable=True, default=0.0)
+    # Сумма и число оценок из отзывов; rating = rating_sum / rating_count
+    rating_sum: Mapped[int] = mapped_column(default=0, server_default='0')
+    rating_count: Mapped[int] = mapped_column(default=0, server_default='0')
     user: Mapped["User"] = relationship(back_populates="master_profile")
     works: Mapped[List["TattooWork"]] = relationship(back_populates="master")
 
+    __table_args__ = (
+        Index('ix_master_profiles_user_id', 'user_id'),
+        Index('ix_master_profiles_is_active_rating', 'is_active', 'rating'),
+    )
+
 
 class Category(Base):
     __tablename__ = 'categories'
@@ -57,6 +71,11 @@ class TattooWork(Base):
     price: Mapped[int] = mapped_column(DECIMAL(10, 2))
     status: Mapped[str] = mapped_column(String(50), default='pending_payment')
     likes_count: Mapped[int] = mapped_column(Integer, default=0)
+    # Денормализованный счетчик, обновляется вместе с добавлением/удалением комментариев
+    comments_count: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    # Ключи сортировки галереи «Популярные» и «В тренде», считаются в ranking.py
+    popular_score: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    trending_score: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
     invoice_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
 
@@ -64,6 +83,15 @@ class TattooWork(Base):
     category: Mapped["Category"] = relationship()
     comments: Mapped[List["Comment"]] = relationship(back_populates="work", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index('ix_tattoo_works_status_id', 'status', 'id'),
+        Index('ix_tattoo_works_status_category_id_id', 'status', 'category_id', 'id'),
+        Index('ix_tattoo_works_master_id_id', 'master_id', 'id'),
+        Index('ix_tattoo_works_invoice_id', 'invoice_id'),
+        Index('ix_tattoo_works_status_popular_score_id', 'status', 'popular_score', 'id'),
+        Index('ix_tattoo_works_status_trending_score_id', 'status', 'trending_score', 'id'),
+    )
+
 
 class Review(Base):
     __tablename__ = 'reviews'
@@ -76,6 +104,10 @@ class Review(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
     admin_reply: Mapped[str] = mapped_column(Text, nullable=True)
 
+    __table_args__ = (
+        Index('ix_reviews_master_id_id', 'master_id', 'id'),
+    )
+
 
 class Like(Base):
     __tablename__ = 'likes'
@@ -84,6 +116,7 @@ class Like(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('user_id', 'work_id'),
+        Index('ix_likes_work_id', 'work_id'),
     )
 
 
@@ -94,11 +127,70 @@ class Comment(Base):
     work_id: Mapped[int] = mapped_column(ForeignKey('tattoo_works.id'))
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
     text: Mapped[str] = mapped_column(Text)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+    # Как и у Payment, время ставит Python: created_at входит в ключ пагинации.
+    # Время в UTC, как у старых записей от func.now(), иначе на сервере не в UTC порядок нарушится
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
 
     work: Mapped["TattooWork"] = relationship(back_populates="comments")
     user: Mapped["User"] = relationship()
 
+    __table_args__ = (
+        Index('ix_comments_work_id_created_at_id', 'work_id', 'created_at', 'id'),
+    )
+
+
+class Payment(Base):
+    """Счет Crypto Pay: оплата размещения работы или статуса мастера."""
+    __tablename__ = 'payments'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    invoice_id: Mapped[int] = mapped_column(BigInteger, unique=True)
+    kind: Mapped[str] = mapped_column(String(30))  # 'work_placement', 'master_registration'
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
+    work_id: Mapped[int] = mapped_column(ForeignKey('tattoo_works.id'), nullable=True)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(18, 8))
+    asset: Mapped[str] = mapped_column(String(10))
+    status: Mapped[str] = mapped_column(String(20), default='active')  # 'active', 'paid', 'expired'
+    # Время ставит Python, а не SQLite: func.now() хранит секунды без дробной части,
+    # и такие значения не совпадают с параметром курсора при сравнении (created_at, id).
+    # Как и func.now(), пишем UTC — перенесенные из tattoo_works платежи тоже в UTC
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+    paid_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_payments_status_created_at_id', 'status', 'created_at', 'id'),
+    )
+
+
+class Broadcast(Base):
+    """Задание рассылки. last_user_id — курсор по users.id, до которого рассылка уже дошла."""
+    __tablename__ = 'broadcasts'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    text: Mapped[str] = mapped_column(Text)
+    status: Mapped[str] = mapped_column(String(20), default='running')  # 'running', 'finished'
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    # Аренда: воркер, который ведет рассылку, и время его последнего продления (UTC)
+    owner: Mapped[str] = mapped_column(String(100), nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_broadcasts_status', 'status'),
+    )
+
+
+class WorkerLease(Base):
+    """Именованная аренда фонового задания, которое должен выполнять только один воркер (leases.py)."""
+    __tablename__ = 'worker_leases'
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(100))
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+
 
 class BotSettings(Base):
     __tablename__ = 'bot_settings'
@@ -106,11 +198,35 @@ class BotSettings(Base):
     value: Mapped[str] = mapped_column(String(255))
 
 
-async def create_tables():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+def recount_comments_stmt():
+    """UPDATE, пересчитывающий comments_count всех работ по таблице comments."""
+    actual_count = select(func.count(Comment.id)).where(Comment.work_id == TattooWork.id).scalar_subquery()
+    return update(TattooWork).values(comments_count=actual_count)
+
+
+def apply_review_rating_stmt(master_id: int, rating: int, sign: int = 1):
+    """
+    UPDATE, добавляющий (sign=1) или убирающий (sign=-1) оценку отзыва из рейтинга мастера.
+    Выполняется в одной транзакции со вставкой или удалением отзыва.
+    """
+    new_sum = MasterProfile.rating_sum + sign * rating
+    new_count = MasterProfile.rating_count + sign
+    return (
+        update(MasterProfile)
+        .where(MasterProfile.id == master_id)
+        .values(
+            rating_sum=new_sum,
+            rating_count=new_count,
+            rating=case((new_count > 0, func.round(new_sum / new_count, 2)), else_=0),
+        )
+    )
 
 
-async def get_setting(session: AsyncSession, key: str, default: Optional[str] = None) -> Optional[str]:
-    setting = await session.get(BotSettings, key)
-    return setting.value if setting else default
+def recount_ratings_stmt():
+    """UPDATE, пересчитывающий рейтинги всех мастеров по таблице reviews."""
+    rating_sum = (select(func.coalesce(func.sum(Review.rating), 0))
+                  .where(Review.master_id == MasterProfile.id).scalar_subquery())
+    rating_count = select(func.count(Review.id)).where(Review.master_id == MasterProfile.id).scalar_subquery()
+    rating_avg = (select(func.coalesce(func.round(func.avg(Review.rating), 2), 0))
+                  .where(Review.master_id == MasterProfile.id).scalar_subquery())
+    return update(MasterProfile).values(rating_sum=rating_sum, rating_count=rating_count, rating=rating_avg)
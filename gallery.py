@@ -0,0 +1,284 @@
+# gallery.py
+
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+
+from sqlalchemy import select, exists, asc, desc, tuple_, Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from cache import TTLCache
+from config import settings
+from database import TattooWork, MasterProfile, User, Category, Like, Comment
+
+# Формат created_at комментария в callback_data (без двоеточий — они разделяют поля)
+COMMENT_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+@dataclass(frozen=True)
+class WorkCard:
+    """Все, что нужно для отрисовки карточки работы в галерее."""
+    id: int
+    master_id: int
+    image_file_id: str
+    description: str
+    price: Decimal
+    likes_count: int
+    category_name: Optional[str]
+    master_username: Optional[str]
+    is_liked: bool
+    comments_count: int
+    popular_score: int
+    trending_score: int
+
+    def score(self, sort: Optional[str]) -> Optional[int]:
+        """Ключ сортировки работы; None для сортировки по id."""
+        return getattr(self, GALLERY_SORTS[sort].key) if sort else None
+
+
+# Сортировки галереи по счету (ranking.py): лучшие работы первыми. Без сортировки — по возрастанию id.
+GALLERY_SORTS = {
+    'popular': TattooWork.popular_score,
+    'trending': TattooWork.trending_score,
+}
+
+
+def work_card_stmt(viewer_id: int) -> Select:
+    """Карточка работы вместе с именем стиля, мастером, лайком зрителя и числом комментариев — одним запросом."""
+    is_liked = exists().where(Like.user_id == viewer_id, Like.work_id == TattooWork.id)
+    return (
+        select(
+            TattooWork.id,
+            TattooWork.master_id,
+            TattooWork.image_file_id,
+            TattooWork.description,
+            TattooWork.price,
+            TattooWork.likes_count,
+            Category.name.label("category_name"),
+            User.username.label("master_username"),
+            is_liked.label("is_liked"),
+            TattooWork.comments_count,
+            TattooWork.popular_score,
+            TattooWork.trending_score,
+        )
+        .join(MasterProfile, MasterProfile.id == TattooWork.master_id)
+        .join(User, User.id == MasterProfile.user_id)
+        .outerjoin(Category, Category.id == TattooWork.category_id)
+    )
+
+
+def gallery_page_stmt(viewer_id: int, work_id: Optional[int] = None, direction: str = 'first',
+                      category_id: Optional[int] = None, limit: int = 1,
+                      sort: Optional[str] = None, score: Optional[int] = None) -> Select:
+    """
+    Запрос карточек галереи (по умолчанию одной).
+
+    direction: 'first' — первая работа, 'next'/'prev' — соседние относительно work_id
+    (для 'prev' — в обратном порядке), 'exact' — сама работа work_id (возврат к работе из комментариев).
+    sort: None — по возрастанию id, иначе ключ GALLERY_SORTS; тогда работы идут по убыванию (счет, id),
+    а score — счет работы work_id.
+    """
+    stmt = work_card_stmt(viewer_id)
+
+    if direction == 'exact':
+        return stmt.where(TattooWork.id == work_id).limit(1)
+
+    stmt = stmt.where(TattooWork.status == 'published')
+    if category_id:
+        stmt = stmt.where(TattooWork.category_id == category_id)
+
+    if sort is None:
+        if direction == 'first':
+            stmt = stmt.order_by(asc(TattooWork.id))
+        elif direction == 'next':
+            stmt = stmt.where(TattooWork.id > work_id).order_by(asc(TattooWork.id))
+        elif direction == 'prev':
+            stmt = stmt.where(TattooWork.id < work_id).order_by(desc(TattooWork.id))
+        else:
+            raise ValueError(f"Неизвестное направление пагинации: {direction}")
+        return stmt.limit(limit)
+
+    column = GALLERY_SORTS.get(sort)
+    if column is None:
+        raise ValueError(f"Неизвестная сортировка галереи: {sort}")
+    if direction != 'first' and score is None:
+        raise ValueError(f"Не передан счет работы для сортировки {sort}")
+    key = tuple_(column, TattooWork.id)
+
+    if direction == 'first':
+        stmt = stmt.order_by(desc(column), desc(TattooWork.id))
+    elif direction == 'next':
+        stmt = stmt.where(key < tuple_(score, work_id)).order_by(desc(column), desc(TattooWork.id))
+    elif direction == 'prev':
+        stmt = stmt.where(key > tuple_(score, work_id)).order_by(asc(column), asc(TattooWork.id))
+    else:
+        raise ValueError(f"Неизвестное направление пагинации: {direction}")
+    return stmt.limit(limit)
+
+
+def _to_card(row) -> WorkCard:
+    data = row._asdict()
+    data["is_liked"] = bool(data["is_liked"])
+    return WorkCard(**data)
+
+
+async def fetch_work_card(session: AsyncSession, viewer_id: int, work_id: Optional[int] = None,
+                          direction: str = 'first', category_id: Optional[int] = None) -> Optional[WorkCard]:
+    """Загружает карточку опубликованной работы для галереи (см. gallery_page_stmt)."""
+    stmt = gallery_page_stmt(viewer_id, work_id=work_id, direction=direction, category_id=category_id)
+    row = (await session.execute(stmt)).first()
+    return _to_card(row) if row is not None else None
+
+
+# --- ПРЕДЗАГРУЗКА ГАЛЕРЕИ ---
+#
+# Для каждого листающего пользователя хранится окно: до settings.gallery_prefetch_size карточек
+# с каждой стороны от работы, на которой окно загружено. Пока следующая карточка есть в окне,
+# нажатие ⬅️/➡️ не обращается к БД; иначе окно перезагружается вокруг текущей работы.
+# Окна сбрасываются при публикации, отклонении и удалении работ и стилей, а окно зрителя — после его лайка
+# или комментария.
+#
+# Позиция в ленте — кортеж, возрастающий по ходу листания: (id,) без сортировки
+# и (-счет, -id) для сортировок по счету.
+
+FeedKey = tuple[int, ...]
+
+
+def _feed_key(sort: Optional[str], work_id: int, score: Optional[int]) -> FeedKey:
+    return (work_id,) if sort is None else (-score, -work_id)
+
+
+def _card_key(card: WorkCard, sort: Optional[str]) -> FeedKey:
+    return _feed_key(sort, card.id, card.score(sort))
+
+
+@dataclass(frozen=True)
+class GalleryWindow:
+    category_id: Optional[int]
+    sort: Optional[str]
+    # Все опубликованные работы фильтра с lo <= позиция <= hi в порядке ленты.
+    # lo / hi = None — окно доходит до начала / конца галереи.
+    cards: tuple[WorkCard, ...]
+    lo: Optional[FeedKey]
+    hi: Optional[FeedKey]
+
+    def step(self, position: Optional[FeedKey], direction: str) -> tuple[bool, Optional[WorkCard]]:
+        """
+        Соседняя с position карточка (position None — начало галереи). Возвращает (ответ известен, карточка);
+        карточка None при известном ответе — дальше работ нет.
+        """
+        if direction == 'next':
+            if position is None:
+                return self.lo is None, (self.cards[0] if self.cards else None)
+            if self.lo is not None and position < self.lo:
+                return False, None
+            card = next((card for card in self.cards if _card_key(card, self.sort) > position), None)
+            return card is not None or self.hi is None, card
+        if self.hi is not None and position > self.hi:
+            return False, None
+        card = next((card for card in reversed(self.cards) if _card_key(card, self.sort) < position), None)
+        return card is not None or self.lo is None, card
+
+
+gallery_windows = TTLCache(ttl=settings.gallery_prefetch_ttl, maxsize=settings.gallery_prefetch_users)
+
+
+def invalidate_gallery() -> None:
+    """Состав галереи изменился — сбрасывает окна всех пользователей."""
+    gallery_windows.clear()
+
+
+def invalidate_gallery_viewer(viewer_id: int) -> None:
+    """Лайк или комментарий зрителя меняет его карточки."""
+    gallery_windows.invalidate(viewer_id)
+
+
+async def _load_window(session: AsyncSession, viewer_id: int, category_id: Optional[int], sort: Optional[str],
+                       work_id: Optional[int], score: Optional[int]) -> GalleryWindow:
+    size = settings.gallery_prefetch_size
+
+    async def load(*args) -> list[WorkCard]:
+        rows = await session.execute(gallery_page_stmt(viewer_id, *args, category_id, size + 1, sort, score))
+        return [_to_card(row) for row in rows]
+
+    if work_id is None:
+        after, before = await load(None, 'first'), []
+    else:
+        # id целые, поэтому 'next' от соседнего id (work_id - 1 по возрастанию, work_id + 1 по убыванию
+        # при том же счете) захватывает и саму работу work_id: без нее в окне была бы дыра
+        after = await load(work_id - 1 if sort is None else work_id + 1, 'next')
+        before = await load(work_id, 'prev')
+    # Лишняя (size + 1)-я карточка лишь показывает, что галерея на этом не заканчивается
+    hi = _card_key(after[size - 1], sort) if len(after) > size else None
+    lo = _card_key(before[size - 1], sort) if len(before) > size else None
+    cards = before[:size][::-1] + after[:size]
+    return GalleryWindow(category_id, sort, tuple(cards), lo, hi)
+
+
+async def fetch_gallery_card(session: AsyncSession, viewer_id: int, work_id: Optional[int] = None,
+                             direction: str = 'first', category_id: Optional[int] = None,
+                             sort: Optional[str] = None, score: Optional[int] = None) -> Optional[WorkCard]:
+    """Как fetch_work_card для 'first'/'next'/'prev', но по возможности из окна предзагрузки."""
+    if sort is not None and sort not in GALLERY_SORTS:
+        raise ValueError(f"Неизвестная сортировка галереи: {sort}")
+    if direction == 'first':
+        work_id, direction = None, 'next'
+    elif direction not in ('next', 'prev'):
+        raise ValueError(f"Неизвестное направление пагинации: {direction}")
+    elif sort is not None and score is None:
+        raise ValueError(f"Не передан счет работы для сортировки {sort}")
+    category_id = category_id or None
+    position = None if work_id is None else _feed_key(sort, work_id, score)
+
+    window = gallery_windows.get(viewer_id)
+    if window is not None and (window.category_id, window.sort) == (category_id, sort):
+        known, card = window.step(position, direction)
+        if known:
+            return card
+
+    window = await _load_window(session, viewer_id, category_id, sort, work_id, score)
+    gallery_windows.set(viewer_id, window)
+    return window.step(position, direction)[1]
+
+
+# --- КОММЕНТАРИИ ---
+
+def comment_cursor(comment: Comment) -> tuple[str, int]:
+    """Ключ (created_at, id) комментария в виде, пригодном для callback_data."""
+    return comment.created_at.strftime(COMMENT_CURSOR_FORMAT), comment.id
+
+
+def parse_comment_cursor(created_at: str, comment_id: int) -> tuple[datetime, int]:
+    return datetime.strptime(created_at, COMMENT_CURSOR_FORMAT), comment_id
+
+
+def comments_page_stmt(work_id: int, per_page: int, direction: str = 'first',
+                       cursor: Optional[tuple[datetime, int]] = None) -> Select:
+    """
+    Страница комментариев работы, новые сверху: порядок (created_at DESC, id DESC).
+
+    cursor — ключ последнего комментария текущей страницы для 'next'
+    или первого комментария для 'prev'.
+    """
+    stmt = select(Comment).where(Comment.work_id == work_id).options(joinedload(Comment.user))
+    key = tuple_(Comment.created_at, Comment.id)
+
+    if direction == 'first':
+        stmt = stmt.order_by(desc(Comment.created_at), desc(Comment.id))
+    elif direction == 'next':
+        stmt = stmt.where(key < tuple_(*cursor)).order_by(desc(Comment.created_at), desc(Comment.id))
+    elif direction == 'prev':
+        stmt = stmt.where(key > tuple_(*cursor)).order_by(asc(Comment.created_at), asc(Comment.id))
+    else:
+        raise ValueError(f"Неизвестное направление пагинации: {direction}")
+    return stmt.limit(per_page)
+
+
+async def fetch_comments_page(session: AsyncSession, work_id: int, per_page: int, direction: str = 'first',
+                              cursor: Optional[tuple[datetime, int]] = None) -> list[Comment]:
+    comments = list(await session.scalars(comments_page_stmt(work_id, per_page, direction, cursor)))
+    if direction == 'prev':
+        comments.reverse()
+    return comments
@@ -3,12 +3,35 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.filters.callback_data import CallbackData
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from typing import Optional, List
+from functools import lru_cache, wraps
+from typing import Callable, NamedTuple, Optional, List
 
 from database import Category
 
 
 # --- CALLBACKS ---
+#
+# aiogram разбирает callback_data, только если число полей совпадает с классом. Кнопки, уже
+# отправленные до смены формата, приходят в старом виде: @legacy_layout разбирает их по старому
+# списку полей, а новые поля в них остаются None (поэтому они должны быть Optional).
+
+def legacy_layout(*fields: str):
+    def decorator(cls):
+        unpack = cls.unpack
+
+        def unpack_legacy(value: str):
+            prefix, *parts = value.split(cls.__separator__)
+            if len(parts) == len(fields):
+                # Поля старого формата, которых больше нет в классе, отбрасываются
+                old = dict(zip(fields, parts))
+                value = cls.__separator__.join([prefix, *(old.get(name, "") for name in cls.model_fields)])
+            return unpack(value)
+
+        cls.unpack = unpack_legacy
+        return cls
+
+    return decorator
+
 
 class MasterProfileEditCallback(CallbackData, prefix="master_edit"):
     action: str  # 'city', 'description', 'socials'
@@ -31,9 +54,13 @@ class MasterSearchCallback(CallbackData, prefix="master_search"):
     action: str  # 'show_all', 'by_city'
 
 
+@legacy_layout("action", "page", "city")
 class MasterListPagination(CallbackData, prefix="master_pag"):
     action: str  # 'prev', 'next'
     page: int
+    # Ключ (rating, id) мастера на текущей странице; нет у кнопок старого формата
+    rating: Optional[str] = None
+    master_id: Optional[int] = None
     city: Optional[str] = None
 
 
@@ -42,6 +69,10 @@ class WorkFilterCallback(CallbackData, prefix="work_filter"):
     category_id: Optional[int] = None
 
 
+class WorkSortCallback(CallbackData, prefix="work_sort"):
+    sort: str  # 'popular', 'trending'
+
+
 class MyWorksPaginationCallback(CallbackData, prefix="my_works_pag"):
     action: str
     work_id: int
@@ -66,9 +97,13 @@ class AdminMailingCallback(CallbackData, prefix="admin_mail"):
     action: str  # 'send', 'cancel'
 
 
+# Старый формат хранил id работы, а не платежа: ключом он служить не может и отбрасывается
+@legacy_layout("action", "work_id")
 class AdminPaymentCallback(CallbackData, prefix="admin_payment"):
     action: str  # 'prev', 'next'
-    work_id: int
+    # Ключ (created_at, id) текущего платежа; нет у кнопок старого формата
+    payment_id: Optional[int] = None
+    created_at: Optional[str] = None
 
 
 class WorkPaginationCallback(CallbackData, prefix="work_pag"):
@@ -77,6 +112,16 @@ class WorkPaginationCallback(CallbackData, prefix="work_pag"):
     category_id: Optional[int] = None
 
 
+class RankedWorkPaginationCallback(CallbackData, prefix="work_rank"):
+    """Листание галереи, отсортированной по счету. Отдельный префикс, чтобы не менять формат work_pag."""
+    action: str  # 'prev', 'next'
+    # Ключ (счет, id) текущей работы
+    current_work_id: int
+    score: int
+    sort: str
+    category_id: Optional[int] = None
+
+
 class LikeCallback(CallbackData, prefix="like"):
     action: str
     work_id: int
@@ -87,10 +132,14 @@ class CommentCallback(CallbackData, prefix="comment"):
     work_id: int
 
 
+@legacy_layout("action", "work_id", "page")
 class CommentPaginationCallback(CallbackData, prefix="comm_pag"):
     action: str  # 'prev', 'next'
     work_id: int
     page: int
+    # Ключ (created_at, id) крайнего комментария текущей страницы; нет у кнопок старого формата
+    created_at: Optional[str] = None
+    comment_id: Optional[int] = None
 
 
 class ReviewCallback(CallbackData, prefix="review"):
@@ -129,8 +178,21 @@ class AdminUserActionCallback(CallbackData, prefix="admin_user"):
 
 
 # --- КЛАВИАТУРЫ ---
+#
+# Клавиатуры без параметров собираются один раз при импорте (@prebuilt) и отдаются одним и тем же
+# объектом, поэтому возвращенную разметку нельзя изменять.
 
-def get_main_menu_kb(user_role: str = 'client') -> ReplyKeyboardMarkup:
+def prebuilt(build: Callable[[], InlineKeyboardMarkup]) -> Callable[[], InlineKeyboardMarkup]:
+    markup = build()
+
+    @wraps(build)
+    def get() -> InlineKeyboardMarkup:
+        return markup
+
+    return get
+
+
+def _build_main_menu_kb(user_role: str) -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
     builder.row(KeyboardButton(text="🎨 Просмотр работ"), KeyboardButton(text="👥 Просмотр мастеров"))
 
@@ -147,6 +209,15 @@ def get_main_menu_kb(user_role: str = 'client') -> ReplyKeyboardMarkup:
     return builder.as_markup(resize_keyboard=True)
 
 
+_MAIN_MENU_KBS = {role: _build_main_menu_kb(role) for role in ('client', 'master')}
+
+
+def get_main_menu_kb(user_role: str = 'client') -> ReplyKeyboardMarkup:
+    # Все роли, кроме мастера, видят меню клиента
+    return _MAIN_MENU_KBS['master' if user_role == 'master' else 'client']
+
+
+@prebuilt
 def get_master_search_options_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -164,7 +235,8 @@ def get_master_search_options_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def get_master_list_pagination_kb(total_pages: int, current_page: int, city: Optional[str] = None,
+def get_master_list_pagination_kb(total_pages: int, current_page: int, cursor_rating: str, cursor_id: int,
+                                  city: Optional[str] = None,
                                   master_id: Optional[int] = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
@@ -175,7 +247,9 @@ def get_master_list_pagination_kb(total_pages: int, current_page: int, city: Opt
     if current_page > 1:
         nav_buttons.append(
             InlineKeyboardButton(text="⬅️",
-                                 callback_data=MasterListPagination(action="prev", page=prev_page, city=city).pack())
+                                 callback_data=MasterListPagination(action="prev", page=prev_page,
+                                                                    rating=cursor_rating, master_id=cursor_id,
+                                                                    city=city).pack())
         )
 
     if total_pages > 0:
@@ -186,7 +260,9 @@ def get_master_list_pagination_kb(total_pages: int, current_page: int, city: Opt
     if current_page < total_pages:
         nav_buttons.append(
             InlineKeyboardButton(text="➡️",
-                                 callback_data=MasterListPagination(action="next", page=next_page, city=city).pack())
+                                 callback_data=MasterListPagination(action="next", page=next_page,
+                                                                    rating=cursor_rating, master_id=cursor_id,
+                                                                    city=city).pack())
         )
     if nav_buttons:
         builder.row(*nav_buttons)
@@ -201,11 +277,16 @@ def get_master_list_pagination_kb(total_pages: int, current_page: int, city: Opt
     return builder.as_markup()
 
 
+@prebuilt
 def get_work_filter_options_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
         InlineKeyboardButton(text="Показать все работы", callback_data=WorkFilterCallback(action="show_all").pack())
     )
+    builder.row(
+        InlineKeyboardButton(text="🔥 В тренде", callback_data=WorkSortCallback(sort="trending").pack()),
+        InlineKeyboardButton(text="🏆 Популярные", callback_data=WorkSortCallback(sort="popular").pack())
+    )
     builder.row(
         InlineKeyboardButton(text="Фильтр по стилю 🎨", callback_data=WorkFilterCallback(action="by_style").pack())
     )
@@ -227,59 +308,72 @@ def get_category_filter_kb(categories: List[Category]) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def get_pagination_kb(
-        current_work_id: int,
-        master_id: int,
-        likes_count: int,
-        is_liked: bool,
-        comments_count: int,
-        category_id: Optional[int] = None
-) -> InlineKeyboardMarkup:
+def get_style_choice_kb(categories: List[Category]) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    for category in categories:
+        builder.row(InlineKeyboardButton(text=category.name, callback_data=f"style_{category.id}"))
+    return builder.as_markup()
 
-    builder.row(
-        InlineKeyboardButton(
-            text="⬅️",
-            callback_data=WorkPaginationCallback(action="prev", current_work_id=current_work_id,
-                                                 category_id=category_id).pack()
-        ),
-        InlineKeyboardButton(
-            text="➡️",
-            callback_data=WorkPaginationCallback(action="next", current_work_id=current_work_id,
-                                                 category_id=category_id).pack()
-        )
-    )
 
-    like_text = f"❤️ {likes_count}" if not is_liked else f"💔 {likes_count}"
-    builder.row(
-        InlineKeyboardButton(
-            text=like_text,
-            callback_data=LikeCallback(action="toggle", work_id=current_work_id).pack()
-        ),
-        InlineKeyboardButton(
+class _WorkCardTemplate(NamedTuple):
+    prev: InlineKeyboardButton
+    next: InlineKeyboardButton
+    like_callback: str
+    review: InlineKeyboardButton
+    comments_callback: str
+    comment: InlineKeyboardButton
+    master: InlineKeyboardButton
+
+
+@lru_cache(maxsize=10_000)
+def _work_card_template(work_id: int, master_id: int, category_id: Optional[int],
+                        sort: Optional[str], score: Optional[int]) -> _WorkCardTemplate:
+    """Неизменная часть клавиатуры карточки: упакованные callback_data и кнопки с постоянным текстом."""
+    def paginate(action: str) -> str:
+        if sort is None:
+            return WorkPaginationCallback(action=action, current_work_id=work_id, category_id=category_id).pack()
+        return RankedWorkPaginationCallback(action=action, current_work_id=work_id, score=score, sort=sort,
+                                            category_id=category_id).pack()
+
+    return _WorkCardTemplate(
+        prev=InlineKeyboardButton(text="⬅️", callback_data=paginate("prev")),
+        next=InlineKeyboardButton(text="➡️", callback_data=paginate("next")),
+        like_callback=LikeCallback(action="toggle", work_id=work_id).pack(),
+        review=InlineKeyboardButton(
             text="⭐️ Оставить отзыв",
-            callback_data=ReviewCallback(action="create", work_id=current_work_id).pack()
-        )
-    )
-
-    builder.row(
-        InlineKeyboardButton(
-            text=f"💬 Комментарии ({comments_count})",
-            callback_data=CommentCallback(action="view", work_id=current_work_id).pack()
+            callback_data=ReviewCallback(action="create", work_id=work_id).pack()
         ),
-        InlineKeyboardButton(
+        comments_callback=CommentCallback(action="view", work_id=work_id).pack(),
+        comment=InlineKeyboardButton(
             text="✍️ Комментировать",
-            callback_data=CommentCallback(action="create", work_id=current_work_id).pack()
-        )
-    )
-
-    builder.row(
-        InlineKeyboardButton(
+            callback_data=CommentCallback(action="create", work_id=work_id).pack()
+        ),
+        master=InlineKeyboardButton(
             text="👤 Профиль мастера",
             callback_data=MasterCallback(action="view", master_id=master_id).pack()
-        )
+        ),
     )
-    return builder.as_markup()
+
+
+def get_pagination_kb(
+        current_work_id: int,
+        master_id: int,
+        likes_count: int,
+        is_liked: bool,
+        comments_count: int,
+        category_id: Optional[int] = None,
+        sort: Optional[str] = None,
+        score: Optional[int] = None
+) -> InlineKeyboardMarkup:
+    template = _work_card_template(current_work_id, master_id, category_id, sort, score)
+    like_text = f"❤️ {likes_count}" if not is_liked else f"💔 {likes_count}"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [template.prev, template.next],
+        [InlineKeyboardButton(text=like_text, callback_data=template.like_callback), template.review],
+        [InlineKeyboardButton(text=f"💬 Комментарии ({comments_count})", callback_data=template.comments_callback),
+         template.comment],
+        [template.master],
+    ])
 
 
 def get_my_works_pagination_kb(work_id: int) -> InlineKeyboardMarkup:
@@ -291,6 +385,7 @@ def get_my_works_pagination_kb(work_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@prebuilt
 def get_admin_main_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -358,14 +453,19 @@ def get_admin_review_keyboard(review_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@prebuilt
 def get_admin_stats_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="🔄 Обновить", callback_data=AdminMenuCallback(action="statistics_refresh").pack())
+    )
     builder.row(
         InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data=AdminMenuCallback(action="main").pack())
     )
     return builder.as_markup()
 
 
+@prebuilt
 def get_admin_mailing_confirm_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -375,11 +475,13 @@ def get_admin_mailing_confirm_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def get_admin_payment_keyboard(work_id: int) -> InlineKeyboardMarkup:
+def get_admin_payment_keyboard(payment_id: int, created_at: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
-        InlineKeyboardButton(text="⬅️", callback_data=AdminPaymentCallback(action="prev", work_id=work_id).pack()),
-        InlineKeyboardButton(text="➡️", callback_data=AdminPaymentCallback(action="next", work_id=work_id).pack())
+        InlineKeyboardButton(text="⬅️", callback_data=AdminPaymentCallback(
+            action="prev", payment_id=payment_id, created_at=created_at).pack()),
+        InlineKeyboardButton(text="➡️", callback_data=AdminPaymentCallback(
+            action="next", payment_id=payment_id, created_at=created_at).pack())
     )
     builder.row(
         InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data=AdminMenuCallback(action="main").pack())
@@ -387,14 +489,17 @@ def get_admin_payment_keyboard(work_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def get_comments_keyboard(work_id: int, total_pages: int, current_page: int) -> InlineKeyboardMarkup:
+def get_comments_keyboard(work_id: int, total_pages: int, current_page: int,
+                          first_cursor: Optional[tuple[str, int]] = None,
+                          last_cursor: Optional[tuple[str, int]] = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
     nav_buttons = []
-    if current_page > 1:
+    if current_page > 1 and first_cursor:
         nav_buttons.append(
             InlineKeyboardButton(text="⬅️", callback_data=CommentPaginationCallback(
-                action="prev", page=current_page - 1, work_id=work_id).pack())
+                action="prev", page=current_page - 1, work_id=work_id,
+                created_at=first_cursor[0], comment_id=first_cursor[1]).pack())
         )
 
     if total_pages > 0:
@@ -402,10 +507,11 @@ def get_comments_keyboard(work_id: int, total_pages: int, current_page: int) ->
             InlineKeyboardButton(text=f"{current_page}/{total_pages}", callback_data="do_nothing")
         )
 
-    if current_page < total_pages:
+    if current_page < total_pages and last_cursor:
         nav_buttons.append(
             InlineKeyboardButton(text="➡️", callback_data=CommentPaginationCallback(
-                action="next", page=current_page + 1, work_id=work_id).pack())
+                action="next", page=current_page + 1, work_id=work_id,
+                created_at=last_cursor[0], comment_id=last_cursor[1]).pack())
         )
 
     if nav_buttons:
@@ -418,6 +524,7 @@ def get_comments_keyboard(work_id: int, total_pages: int, current_page: int) ->
     return builder.as_markup()
 
 
+@prebuilt
 def get_rating_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     buttons = [InlineKeyboardButton(text=f"{i} ⭐", callback_data=f"rating_{i}") for i in range(1, 6)]
@@ -450,7 +557,7 @@ def get_admin_moderation_kb(work_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def get_admin_settings_kb(master_price: str) -> InlineKeyboardMarkup:
+def get_admin_settings_kb(master_price: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
         InlineKeyboardButton(text=f"💰 Цена за статус мастера ({master_price} USDT)",
@@ -483,6 +590,7 @@ def get_admin_user_manage_kb(user_id: int, is_active: bool, role: str) -> Inline
     return builder.as_markup()
 
 
+@prebuilt
 def get_master_profile_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="⭐️ Мои отзывы", callback_data="master_reviews_view"))
@@ -506,6 +614,7 @@ def get_master_review_keyboard(review_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@prebuilt
 def get_master_profile_edit_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
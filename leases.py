@@ -0,0 +1,54 @@
+# leases.py
+#
+# Аренда фоновых заданий между воркерами бота. Задание выполняет тот воркер, чей WORKER_ID
+# записан владельцем; владелец периодически продлевает аренду, а если он пропал,
+# задание после истечения аренды забирает другой воркер.
+#
+# Рассылки арендуются по строке задания (broadcast.py), задания-одиночки вроде сверки платежей —
+# по имени в таблице worker_leases.
+
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import WorkerLease, utcnow
+
+# Уникален для каждого запуска процесса, даже при повторно выданном pid
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def acquire_lease(session: AsyncSession, name: str, ttl: float) -> bool:
+    """Захватывает или продлевает аренду name на ttl секунд. False — ею владеет другой живой воркер."""
+    now = utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    result = await session.execute(
+        update(WorkerLease)
+        .where(WorkerLease.name == name, or_(WorkerLease.owner == WORKER_ID, WorkerLease.expires_at < now))
+        .values(owner=WORKER_ID, expires_at=expires_at)
+    )
+    if result.rowcount == 1:
+        await session.commit()
+        return True
+    # Строки аренды еще нет; одновременную вставку двумя воркерами отсекает первичный ключ
+    session.add(WorkerLease(name=name, owner=WORKER_ID, expires_at=expires_at))
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        return False
+    return True
+
+
+async def release_lease(session: AsyncSession, name: str) -> None:
+    """Отпускает аренду при остановке, чтобы другой воркер забрал задание сразу."""
+    await session.execute(
+        update(WorkerLease)
+        .where(WorkerLease.name == name, WorkerLease.owner == WORKER_ID)
+        .values(expires_at=utcnow())
+    )
+    await session.commit()
@@ -2,12 +2,20 @@ import asyncio
 import logging
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 
+from callback_index import CallbackPrefixIndex
 from config import settings
-from database import async_session_factory, create_tables
-from middlewares import DbSessionMiddleware
+from crypto_api import crypto_api
+from database import async_session_factory
+from migrations import run_migrations
+from middlewares import DbSessionMiddleware, CurrentUserMiddleware
+from broadcast import resume_broadcasts, stop_broadcasts
+from payments import start_payment_reconciler, stop_payment_reconciler
+from settings_registry import start_settings_registry, stop_settings_registry
+from stats import start_stats_refresher, stop_stats_refresher
+from storage import create_fsm_storage
+from webhook import run_webhook, run_polling
 
 from user_handlers import router as user_router
 from master_handlers import router as master_router
@@ -18,9 +26,9 @@ from admin_extended_handlers import router as admin_extended_router # <-- Имп
 async def main():
     logging.basicConfig(level=logging.INFO)
 
-    await create_tables()
+    await run_migrations()
 
-    storage = MemoryStorage()
+    storage = create_fsm_storage()
 
     bot = Bot(
         token=settings.bot_token.get_secret_value(),
@@ -29,15 +37,34 @@ async def main():
     dp = Dispatcher(storage=storage)
 
     dp.update.middleware(DbSessionMiddleware(session_pool=async_session_factory))
+    # Должен идти после DbSessionMiddleware: при промахе кэша использует сессию
+    dp.update.middleware(CurrentUserMiddleware())
 
     # Регистрируем роутеры. Важен порядок: сначала более специфичные (админские), потом общие.
     dp.include_router(admin_router)
     dp.include_router(admin_extended_router) # <-- Регистрируем новый роутер
     dp.include_router(master_router)
     dp.include_router(user_router)
+    # Индекс строится по уже подключенным роутерам, поэтому регистрируется после них
+    dp.callback_query.outer_middleware(CallbackPrefixIndex(dp))
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    dp.startup.register(start_settings_registry)
+    dp.startup.register(crypto_api.start)
+    dp.startup.register(start_stats_refresher)
+    dp.startup.register(resume_broadcasts)
+    dp.startup.register(start_payment_reconciler)
+    dp.shutdown.register(stop_stats_refresher)
+    dp.shutdown.register(stop_broadcasts)
+    dp.shutdown.register(stop_payment_reconciler)
+    dp.shutdown.register(crypto_api.close)
+    dp.shutdown.register(stop_settings_registry)
+
+    if settings.run_mode == 'webhook':
+        await run_webhook(dp, bot)
+    elif settings.run_mode == 'polling':
+        await run_polling(dp, bot)
+    else:
+        raise ValueError(f"Неизвестный режим запуска: {settings.run_mode}")
 
 
 if __name__ == "__main__":
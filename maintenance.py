@@ -0,0 +1,200 @@
+# maintenance.py
+#
+# Служебные команды для обслуживания БД.
+# Запуск: python maintenance.py <команда>
+
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import select, update, func, desc, asc, text, tuple_, Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import (async_session_factory, engine, TattooWork, Comment, Review, MasterProfile, User, Like, Payment,
+                      recount_comments_stmt, recount_ratings_stmt)
+from gallery import gallery_page_stmt, comments_page_stmt
+from masters import master_page_stmt
+from ranking import popular_score, trending_score
+from payments import paid_payments_page_stmt
+from migrations import run_migrations
+
+
+# --- СЧЕТЧИК КОММЕНТАРИЕВ ---
+
+async def backfill_comments_count(session: AsyncSession) -> int:
+    """Пересчитывает comments_count всех работ. Возвращает число обновленных строк."""
+    result = await session.execute(recount_comments_stmt())
+    await session.commit()
+    return result.rowcount
+
+
+async def verify_comments_count(session: AsyncSession) -> list[tuple[int, int, int]]:
+    """Возвращает работы, у которых счетчик расходится с реальным числом комментариев: (id, в счетчике, реально)."""
+    actual_count = select(func.count(Comment.id)).where(Comment.work_id == TattooWork.id).scalar_subquery()
+    result = await session.execute(
+        select(TattooWork.id, TattooWork.comments_count, actual_count)
+        .where(TattooWork.comments_count != actual_count)
+        .order_by(TattooWork.id)
+    )
+    return [tuple(row) for row in result.all()]
+
+
+# --- РЕЙТИНГ МАСТЕРОВ ---
+
+async def rebuild_master_ratings(session: AsyncSession) -> int:
+    """Пересчитывает rating_sum, rating_count и rating всех мастеров по отзывам. Возвращает число мастеров."""
+    result = await session.execute(recount_ratings_stmt())
+    await session.commit()
+    return result.rowcount
+
+
+# --- СЧЕТ РАБОТ ---
+
+async def rebuild_work_scores(session: AsyncSession) -> int:
+    """Пересчитывает popular_score и trending_score всех работ (после смены формулы в ranking.py)."""
+    rows = await session.execute(
+        select(TattooWork.id, TattooWork.likes_count, TattooWork.comments_count, TattooWork.created_at)
+    )
+    scores = []
+    for work_id, likes_count, comments_count, created_at in rows:
+        popular = popular_score(likes_count, comments_count)
+        scores.append({'id': work_id, 'popular_score': popular, 'trending_score': trending_score(popular, created_at)})
+    if scores:
+        await session.execute(update(TattooWork), scores)
+    await session.commit()
+    return len(scores)
+
+
+# --- ПРОВЕРКА ИНДЕКСОВ ---
+
+def hot_queries() -> dict[str, Select]:
+    """Самые частые запросы бота в том виде, в котором их выполняют хендлеры."""
+    return {
+        "галерея: первая работа": gallery_page_stmt(viewer_id=1, direction='first'),
+        "галерея: следующая работа": gallery_page_stmt(viewer_id=1, work_id=10, direction='next'),
+        "галерея: следующая в стиле": gallery_page_stmt(viewer_id=1, work_id=10, direction='next', category_id=1),
+        "галерея: предыдущая в стиле": gallery_page_stmt(viewer_id=1, work_id=10, direction='prev', category_id=1),
+        "галерея: первая популярная": gallery_page_stmt(viewer_id=1, direction='first', sort='popular'),
+        "галерея: следующая популярная": gallery_page_stmt(viewer_id=1, work_id=10, direction='next',
+                                                          sort='popular', score=5),
+        "галерея: предыдущая в тренде": gallery_page_stmt(viewer_id=1, work_id=10, direction='prev',
+                                                         sort='trending', score=200_000),
+        "мои работы: следующая": select(TattooWork).where(TattooWork.master_id == 1, TattooWork.id > 10)
+                                 .order_by(asc(TattooWork.id)).limit(1),
+        "отзывы мастера: следующий": select(Review).where(Review.master_id == 1, Review.id < 10)
+                                     .order_by(desc(Review.id)).limit(1),
+        "комментарии: первая страница": comments_page_stmt(work_id=1, per_page=5),
+        "комментарии: следующая": comments_page_stmt(work_id=1, per_page=5, direction='next',
+                                                     cursor=(datetime(2024, 1, 1), 10)),
+        "комментарии: предыдущая": comments_page_stmt(work_id=1, per_page=5, direction='prev',
+                                                      cursor=(datetime(2024, 1, 1), 10)),
+        "каталог мастеров: первая страница": master_page_stmt('first'),
+        "каталог мастеров: следующая": master_page_stmt('next', cursor=(Decimal('4.50'), 10)),
+        "каталог мастеров: предыдущая": master_page_stmt('prev', cursor=(Decimal('4.50'), 10)),
+        "сверка платежей": select(Payment).where(Payment.status == 'active',
+                                                 tuple_(Payment.created_at, Payment.id) > (datetime(2024, 1, 1), 10))
+                            .order_by(asc(Payment.created_at), asc(Payment.id)).limit(100),
+        "вебхук оплаты": select(Payment).where(Payment.invoice_id == 1000),
+        "платежи: следующий": paid_payments_page_stmt('next', cursor=(datetime(2024, 1, 1), 10)),
+        "платежи: предыдущий": paid_payments_page_stmt('prev', cursor=(datetime(2024, 1, 1), 10)),
+        "лайки работы": select(func.count()).select_from(Like).where(Like.work_id == 1),
+        "текущий пользователь": select(User, MasterProfile).outerjoin(MasterProfile, MasterProfile.user_id == User.id)
+                                .where(User.telegram_id == 1),
+    }
+
+
+def _plan_problems(plan: list[str]) -> list[str]:
+    """Строки плана SQLite, означающие полный проход по таблице или сортировку без индекса."""
+    return [line for line in plan if line.startswith("SCAN ") or "TEMP B-TREE" in line]
+
+
+async def check_query_plans(session: AsyncSession) -> dict[str, tuple[list[str], list[str]]]:
+    """Выполняет EXPLAIN для каждого частого запроса. Возвращает {запрос: (план, проблемные строки)}."""
+    dialect = session.bind.dialect
+    results = {}
+    for name, stmt in hot_queries().items():
+        sql = str(stmt.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+        if dialect.name == 'sqlite':
+            rows = await session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))
+            plan = [row.detail for row in rows]
+            results[name] = (plan, _plan_problems(plan))
+        else:
+            # Для остальных СУБД выводим план как есть: на маленьких таблицах
+            # планировщик вправе выбрать последовательное чтение.
+            rows = await session.execute(text(f"EXPLAIN {sql}"))
+            results[name] = ([row[0] for row in rows], [])
+    return results
+
+
+# --- CLI ---
+
+async def cmd_backfill_comments() -> None:
+    async with async_session_factory() as session:
+        updated = await backfill_comments_count(session)
+    print(f"Пересчитано работ: {updated}")
+
+
+async def cmd_verify_comments() -> None:
+    async with async_session_factory() as session:
+        mismatches = await verify_comments_count(session)
+    if not mismatches:
+        print("Счетчики комментариев в порядке.")
+        return
+    for work_id, stored, actual in mismatches:
+        print(f"Работа #{work_id}: в счетчике {stored}, реально {actual}")
+    print(f"Расхождений: {len(mismatches)}. Исправить: python maintenance.py backfill-comments")
+
+
+async def cmd_rebuild_ratings() -> None:
+    async with async_session_factory() as session:
+        updated = await rebuild_master_ratings(session)
+    print(f"Пересчитано мастеров: {updated}")
+
+
+async def cmd_rebuild_scores() -> None:
+    async with async_session_factory() as session:
+        updated = await rebuild_work_scores(session)
+    print(f"Пересчитано работ: {updated}")
+
+
+async def cmd_check_indexes() -> None:
+    async with async_session_factory() as session:
+        results = await check_query_plans(session)
+    failed = 0
+    for name, (plan, problems) in results.items():
+        print(f"{'❌' if problems else '✅'} {name}")
+        for line in plan:
+            print(f"    {line}")
+        failed += bool(problems)
+    print(f"Запросов без индекса: {failed}")
+    if failed:
+        raise SystemExit(1)
+
+
+COMMANDS = {
+    'backfill-comments': cmd_backfill_comments,
+    'verify-comments': cmd_verify_comments,
+    'rebuild-ratings': cmd_rebuild_ratings,
+    'rebuild-scores': cmd_rebuild_scores,
+    'check-indexes': cmd_check_indexes,
+}
+
+
+async def main(command: str) -> None:
+    await run_migrations()
+    try:
+        await COMMANDS[command]()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Служебные команды тату-бота")
+    parser.add_argument('command', choices=COMMANDS.keys())
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    engine.echo = False
+    asyncio.run(main(args.command))
@@ -1,24 +1,24 @@
 from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InputMediaPhoto
-from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.types import Message, CallbackQuery, InputMediaPhoto
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, asc, desc
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, asc, desc, update
 import logging
+from typing import Optional
 
 from states import WorkSubmission, MasterProfileEdit, MasterReviewReply # Добавили MasterReviewReply
-from crypto_api import CryptoAPI
-from config import settings
-from keyboards import (get_payment_kb, get_main_menu_kb, PaymentCallback, get_admin_moderation_kb,
+from crypto_api import crypto_api, CryptoAPIUnavailable
+from payments import mark_work_paid, notify_admins_new_work, record_invoice, PAYMENT_WORK
+from keyboards import (get_payment_kb, get_main_menu_kb, PaymentCallback,
                        get_master_profile_kb, MyWorksPaginationCallback, get_my_works_pagination_kb,
                        get_master_profile_edit_kb, MasterProfileEditCallback, get_master_review_keyboard,
                        MasterReviewCallback) # Добавили get_master_review_keyboard и MasterReviewCallback
-from database import TattooWork, User, MasterProfile, Category, Review # Добавили Review
+from database import TattooWork, User, MasterProfile, Review # Добавили Review
+from middlewares import CachedUser, CachedMaster, invalidate_user
+from categories import get_catalog
 
 
 router = Router()
-crypto_api = CryptoAPI(token=settings.crypto_api_token.get_secret_value())
 
 # Словарь для статусов
 STATUS_TRANSLATE = {
@@ -30,14 +30,13 @@ STATUS_TRANSLATE = {
 
 
 @router.message(F.text == "✍️ Подать свою работу")
-async def submit_work_start(message: Message, state: FSMContext, session: AsyncSession):
-    user = await session.scalar(select(User).where(User.telegram_id == message.from_user.id))
-    if not user or user.role != 'master':
+async def submit_work_start(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser):
+    if db_user.role != 'master':
         await message.answer("Эта функция доступна только для зарегистрированных мастеров.")
         return
 
-    categories_exist = await session.scalar(select(Category).limit(1))
-    if not categories_exist:
+    catalog = await get_catalog(session)
+    if not catalog.names:
         await message.answer(
             "В данный момент не добавлено ни одной категории (стиля) для работ. Пожалуйста, обратитесь к администратору.")
         return
@@ -58,14 +57,9 @@ async def process_work_description(message: Message, state: FSMContext, session:
     await state.update_data(description=message.text)
     await state.set_state(WorkSubmission.waiting_for_style)
 
-    categories = await session.scalars(select(Category).order_by(Category.name))
-
-    builder = InlineKeyboardBuilder()
-    for cat in categories:
-        builder.row(InlineKeyboardButton(text=cat.name, callback_data=f"style_{cat.id}"))
-
+    catalog = await get_catalog(session)
     await message.answer("Описание принято. Теперь выберите стиль татуировки из списка:",
-                         reply_markup=builder.as_markup())
+                         reply_markup=catalog.style_choice_kb)
 
 
 @router.callback_query(WorkSubmission.waiting_for_style, F.data.startswith("style_"))
@@ -82,7 +76,8 @@ async def process_style_choice(query: CallbackQuery, state: FSMContext):
 
 
 @router.message(WorkSubmission.waiting_for_price, F.text)
-async def process_price(message: Message, state: FSMContext, session: AsyncSession):
+async def process_price(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser,
+                        db_master: Optional[CachedMaster]):
     if not message.text.isdigit():
         await message.answer("Пожалуйста, введите цену только цифрами.")
         return
@@ -91,20 +86,21 @@ async def process_price(message: Message, state: FSMContext, session: AsyncSessi
     user_data = await state.get_data()
 
     placement_price = 1  # Цена за размещение
-    invoice = await crypto_api.create_invoice(asset="USDT", amount=placement_price)
+    try:
+        invoice = await crypto_api.create_invoice(asset="USDT", amount=placement_price)
+    except CryptoAPIUnavailable as e:
+        # Состояние не сбрасываем: мастер сможет отправить цену еще раз
+        await message.answer(str(e))
+        return
 
     if invoice:
-        master_profile = await session.scalar(
-            select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id)
-        )
-
-        if not master_profile:
+        if not db_master:
             await message.answer("Произошла ошибка: не найден ваш профиль мастера.")
             await state.clear()
             return
 
         new_work = TattooWork(
-            master_id=master_profile.id,
+            master_id=db_master.id,
             image_file_id=user_data.get("photo_file_id"),
             description=user_data.get("description"),
             category_id=user_data.get("category_id"),
@@ -113,8 +109,10 @@ async def process_price(message: Message, state: FSMContext, session: AsyncSessi
             invoice_id=invoice['invoice_id']
         )
         session.add(new_work)
+        await session.flush() # Получаем id работы для журнала платежей
+        record_invoice(session, invoice, kind=PAYMENT_WORK, user_id=db_user.id, work_id=new_work.id,
+                       amount=placement_price, asset="USDT")
         await session.commit()
-        await session.refresh(new_work) # Обновляем объект, чтобы получить его id
 
         await message.answer(
             f"Ваша работа почти добавлена! Осталось оплатить размещение.\n\nСумма: {placement_price} USDT",
@@ -126,49 +124,35 @@ async def process_price(message: Message, state: FSMContext, session: AsyncSessi
         )
         await state.set_state(WorkSubmission.waiting_for_payment_check)
     else:
-        user = await session.scalar(select(User).where(User.telegram_id == message.from_user.id))
         await message.answer("Не удалось создать счет для оплаты. Попробуйте позже.",
-                             reply_markup=get_main_menu_kb(user.role))
+                             reply_markup=get_main_menu_kb(db_user.role))
         await state.clear()
 
 
-@router.callback_query(PaymentCallback.filter(F.action == "check_payment"))
+# work_id=0 — оплата статуса мастера, ее проверяет check_master_payment в user_handlers
+@router.callback_query(PaymentCallback.filter((F.action == "check_payment") & (F.work_id != 0)))
 async def check_payment(query: types.CallbackQuery, callback_data: PaymentCallback, state: FSMContext,
-                        session: AsyncSession):
+                        session: AsyncSession, db_user: CachedUser):
+    try:
+        invoices_data = await crypto_api.get_invoices(invoice_ids=[callback_data.invoice_id])
+    except CryptoAPIUnavailable as e:
+        await query.answer(str(e), show_alert=True)
+        return
     await query.answer("Проверяем оплату...")
-    invoices_data = await crypto_api.get_invoices(invoice_ids=[callback_data.invoice_id])
 
     if invoices_data and invoices_data.get('items'):
         invoice = invoices_data['items'][0]
         if invoice['status'] == 'paid':
             work = await session.get(TattooWork, callback_data.work_id)
-            if work and work.status == 'pending_payment':
-                work.status = 'pending_approval'
-                await session.commit()
-
+            # Работу могла уже подтвердить фоновая сверка (payments.py) — тогда уведомления не дублируем
+            if work and work.status == 'pending_payment' and await mark_work_paid(session, work.id):
                 await query.message.edit_text("✅ Оплата прошла успешно! Ваша работа отправлена на модерацию.")
-
-                admin_ids = [int(i) for i in settings.admin_ids.split(',')]
-                for admin_id in admin_ids:
-                    try:
-                        category = await session.get(Category, work.category_id)
-                        await query.bot.send_photo(
-                            chat_id=admin_id,
-                            photo=work.image_file_id,
-                            caption=f"Новая работа на модерацию!\n\n"
-                                    f"Мастер: @{query.from_user.username}\n"
-                                    f"Описание: {work.description}\n"
-                                    f"Стиль: {category.name if category else 'Не указан'}\n"
-                                    f"Цена: {work.price} руб.",
-                            reply_markup=get_admin_moderation_kb(work.id)
-                        )
-                    except Exception as e:
-                        logging.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
-
-                current_user = await session.scalar(select(User).where(User.telegram_id == query.from_user.id))
                 await state.clear()
                 await query.message.answer("Вы можете добавить еще одну работу или вернуться в главное меню.",
-                                           reply_markup=get_main_menu_kb(current_user.role))
+                                           reply_markup=get_main_menu_kb(db_user.role))
+
+                # Админов уведомляем после ответа мастеру, чтобы он не ждал отправки карточек
+                await notify_admins_new_work(query.bot, session, work.id)
 
             elif work and work.status != 'pending_payment':
                 await query.message.edit_text("Эта работа уже была оплачена.")
@@ -224,11 +208,11 @@ async def show_my_work_func(message_or_query, session: AsyncSession, master_prof
             await query.answer("Это последняя работа в списке.", show_alert=True)
         return
 
-    category = await session.get(Category, work.category_id)
+    category_name = (await get_catalog(session)).name(work.category_id)
     status_text = STATUS_TRANSLATE.get(work.status, work.status)
     caption = (
         f"<b>Статус: {status_text}</b>\n\n"
-        f"<b>Стиль:</b> {category.name if category else 'Не указан'}\n"
+        f"<b>Стиль:</b> {category_name or 'Не указан'}\n"
         f"<b>Описание:</b> {work.description}\n"
         f"<b>Цена:</b> ~{int(work.price)} руб."
     )
@@ -251,34 +235,27 @@ async def show_my_work_func(message_or_query, session: AsyncSession, master_prof
 
 
 @router.message(F.text == "📂 Мои работы")
-async def my_works_start(message: Message, session: AsyncSession):
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id).options(
-            selectinload(MasterProfile.works))
-    )
-    if not master_profile:
+async def my_works_start(message: Message, session: AsyncSession, db_master: Optional[CachedMaster]):
+    if not db_master:
         await message.answer("Не удалось найти ваш профиль мастера.")
         return
-    await show_my_work_func(message, session, master_profile_id=master_profile.id, direction='first')
+    await show_my_work_func(message, session, master_profile_id=db_master.id, direction='first')
 
 
 @router.callback_query(MyWorksPaginationCallback.filter())
-async def my_works_paginated(query: CallbackQuery, callback_data: MyWorksPaginationCallback, session: AsyncSession):
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == query.from_user.id).options(
-            selectinload(MasterProfile.works))
-    )
-    if not master_profile:
+async def my_works_paginated(query: CallbackQuery, callback_data: MyWorksPaginationCallback, session: AsyncSession,
+                             db_master: Optional[CachedMaster]):
+    if not db_master:
         await query.answer("Профиль не найден.", show_alert=True)
         return
 
-    await show_my_work_func(query, session, master_profile_id=master_profile.id, work_id=callback_data.work_id,
+    await show_my_work_func(query, session, master_profile_id=db_master.id, work_id=callback_data.work_id,
                             direction=callback_data.action)
 
 
 # --- ПРОФИЛЬ МАСТЕРА И РЕДАКТИРОВАНИЕ ---
 
-async def get_profile_text(master_profile: MasterProfile) -> str:
+async def get_profile_text(master_profile: CachedMaster) -> str:
     """Формирует текст профиля мастера."""
     profile_text = (
         f"<b>Ваш профиль мастера:</b>\n\n"
@@ -292,30 +269,24 @@ async def get_profile_text(master_profile: MasterProfile) -> str:
 
 
 @router.message(F.text == "👤 Мой профиль")
-async def show_my_profile_handler(message: Message, session: AsyncSession):
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id)
-    )
-    if not master_profile:
+async def show_my_profile_handler(message: Message, db_master: Optional[CachedMaster]):
+    if not db_master:
         await message.answer("Не удалось найти ваш профиль мастера.")
         return
 
-    profile_text = await get_profile_text(master_profile)
+    profile_text = await get_profile_text(db_master)
     await message.answer(profile_text, reply_markup=get_master_profile_kb())
 
 
 @router.callback_query(F.data == "show_my_profile")
-async def show_my_profile_callback(query: CallbackQuery, session: AsyncSession, state: FSMContext):
+async def show_my_profile_callback(query: CallbackQuery, state: FSMContext, db_master: Optional[CachedMaster]):
     await state.clear()
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == query.from_user.id)
-    )
-    if not master_profile:
+    if not db_master:
         await query.message.edit_text("Не удалось найти ваш профиль мастера.")
         await query.answer()
         return
 
-    profile_text = await get_profile_text(master_profile)
+    profile_text = await get_profile_text(db_master)
     await query.message.edit_text(profile_text, reply_markup=get_master_profile_kb())
     await query.answer()
 
@@ -338,13 +309,14 @@ async def ask_for_new_city(query: CallbackQuery, state: FSMContext):
 
 
 @router.message(MasterProfileEdit.waiting_for_new_city, F.text)
-async def process_edit_city(message: Message, state: FSMContext, session: AsyncSession):
+async def process_edit_city(message: Message, state: FSMContext, session: AsyncSession,
+                            db_master: CachedMaster):
     new_city = message.text
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id)
+    await session.execute(
+        update(MasterProfile).where(MasterProfile.id == db_master.id).values(city=new_city)
     )
-    master_profile.city = new_city
     await session.commit()
+    invalidate_user(message.from_user.id)
     await state.clear()
     await message.answer("✅ Ваш город успешно обновлен!", reply_markup=get_main_menu_kb(user_role='master'))
 
@@ -357,13 +329,14 @@ async def ask_for_new_description(query: CallbackQuery, state: FSMContext):
 
 
 @router.message(MasterProfileEdit.waiting_for_new_description, F.text)
-async def process_edit_description(message: Message, state: FSMContext, session: AsyncSession):
+async def process_edit_description(message: Message, state: FSMContext, session: AsyncSession,
+                                   db_master: CachedMaster):
     new_description = message.text
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id)
+    await session.execute(
+        update(MasterProfile).where(MasterProfile.id == db_master.id).values(description=new_description)
     )
-    master_profile.description = new_description
     await session.commit()
+    invalidate_user(message.from_user.id)
     await state.clear()
     await message.answer("✅ Ваше описание успешно обновлено!", reply_markup=get_main_menu_kb(user_role='master'))
 
@@ -376,13 +349,15 @@ async def ask_for_new_socials(query: CallbackQuery, state: FSMContext):
 
 
 @router.message(MasterProfileEdit.waiting_for_new_socials, F.text)
-async def process_edit_socials(message: Message, state: FSMContext, session: AsyncSession):
+async def process_edit_socials(message: Message, state: FSMContext, session: AsyncSession,
+                               db_master: CachedMaster):
     new_social_link = message.text
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id)
+    await session.execute(
+        update(MasterProfile).where(MasterProfile.id == db_master.id).values(
+            social_links=[{"name": "link", "url": new_social_link}])
     )
-    master_profile.social_links = [{"name": "link", "url": new_social_link}]
     await session.commit()
+    invalidate_user(message.from_user.id)
     await state.clear()
     await message.answer("✅ Ваша социальная сеть успешно обновлена!", reply_markup=get_main_menu_kb(user_role='master'))
 
@@ -443,27 +418,22 @@ async def show_master_review(query: CallbackQuery, session: AsyncSession, master
 
 
 @router.callback_query(F.data == "master_reviews_view")
-async def view_master_reviews_start(query: CallbackQuery, session: AsyncSession):
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == query.from_user.id)
-    )
-    if not master_profile:
+async def view_master_reviews_start(query: CallbackQuery, session: AsyncSession, db_master: Optional[CachedMaster]):
+    if not db_master:
         await query.answer("Ваш профиль мастера не найден.", show_alert=True)
         return
 
-    await show_master_review(query, session, master_id=master_profile.id, direction='first')
+    await show_master_review(query, session, master_id=db_master.id, direction='first')
 
 
 @router.callback_query(MasterReviewCallback.filter(F.action.in_(['prev', 'next'])))
-async def paginate_master_reviews(query: CallbackQuery, callback_data: MasterReviewCallback, session: AsyncSession):
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == query.from_user.id)
-    )
-    if not master_profile:
+async def paginate_master_reviews(query: CallbackQuery, callback_data: MasterReviewCallback, session: AsyncSession,
+                                  db_master: Optional[CachedMaster]):
+    if not db_master:
         await query.answer("Ваш профиль мастера не найден.", show_alert=True)
         return
 
-    await show_master_review(query, session, master_id=master_profile.id, review_id=callback_data.review_id,
+    await show_master_review(query, session, master_id=db_master.id, review_id=callback_data.review_id,
                              direction=callback_data.action)
 
 
@@ -476,7 +446,8 @@ async def start_master_reply(query: CallbackQuery, callback_data: MasterReviewCa
 
 
 @router.message(MasterReviewReply.waiting_for_reply_text, F.text)
-async def process_master_reply(message: Message, state: FSMContext, session: AsyncSession):
+async def process_master_reply(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser,
+                               db_master: CachedMaster):
     data = await state.get_data()
     review_id = data.get("review_id")
     reply_text = message.text
@@ -497,21 +468,15 @@ async def process_master_reply(message: Message, state: FSMContext, session: Asy
     client = None
     try:
         client = await session.get(User, review.client_id)
-        # Для уведомления нам нужен профиль мастера
-        master_profile = await session.get(MasterProfile, review.master_id)
-        master_user = await session.get(User, master_profile.user_id)
         if client:
             await message.bot.send_message(
                 client.telegram_id,
-                f"Мастер @{master_user.username or '...'} ответил на ваш отзыв:\n\n<i>{reply_text}</i>"
+                f"Мастер @{db_user.username or '...'} ответил на ваш отзыв:\n\n<i>{reply_text}</i>"
             )
     except Exception as e:
         client_id_for_log = client.telegram_id if client else "unknown"
         logging.error(f"Не удалось отправить уведомление клиенту {client_id_for_log}: {e}")
 
     # Показываем обновленный отзыв мастеру
-    master_profile = await session.scalar(
-        select(MasterProfile).join(User).where(User.telegram_id == message.from_user.id)
-    )
     fake_query = types.CallbackQuery(id="fake", from_user=message.from_user, chat_instance="", message=message)
-    await show_master_review(fake_query, session, master_id=master_profile.id, review_id=review_id, direction=None)
\ No newline at end of file
+    await show_master_review(fake_query, session, master_id=db_master.id, review_id=review_id, direction=None)
\ No newline at end of file
@@ -0,0 +1,63 @@
+# masters.py
+
+from decimal import Decimal
+from typing import Optional
+
+from sqlalchemy import select, func, desc, asc, tuple_, Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from cache import TTLCache
+from database import MasterProfile
+
+# Общее число активных мастеров (всего и по городам) для подписи "страница N/M".
+# Сбрасывается при регистрации и блокировке мастеров, в остальное время живет TTL.
+masters_count_cache = TTLCache(ttl=300, maxsize=1_000)
+
+
+def invalidate_masters_count() -> None:
+    masters_count_cache.clear()
+
+
+def _active_masters_stmt(city: Optional[str]) -> Select:
+    stmt = select(MasterProfile).where(MasterProfile.is_active == True)
+    if city:
+        stmt = stmt.where(func.lower(MasterProfile.city) == city.lower())
+    return stmt
+
+
+async def count_active_masters(session: AsyncSession, city: Optional[str] = None) -> int:
+    key = city.lower() if city else None
+    total = masters_count_cache.get(key)
+    if total is None:
+        total = await session.scalar(select(func.count()).select_from(_active_masters_stmt(city).subquery()))
+        masters_count_cache.set(key, total)
+    return total
+
+
+def master_page_stmt(direction: str = 'first', cursor: Optional[tuple[Decimal, int]] = None,
+                     city: Optional[str] = None) -> Select:
+    """
+    Один мастер каталога в порядке (rating DESC, id DESC).
+
+    cursor — (rating, id) мастера на текущей странице; 'next'/'prev' берут соседа по этому ключу,
+    поэтому стоимость запроса не зависит от номера страницы.
+    """
+    stmt = _active_masters_stmt(city).options(joinedload(MasterProfile.user))
+    key = tuple_(MasterProfile.rating, MasterProfile.id)
+
+    if direction == 'first':
+        stmt = stmt.order_by(desc(MasterProfile.rating), desc(MasterProfile.id))
+    elif direction == 'next':
+        stmt = stmt.where(key < tuple_(*cursor)).order_by(desc(MasterProfile.rating), desc(MasterProfile.id))
+    elif direction == 'prev':
+        stmt = stmt.where(key > tuple_(*cursor)).order_by(asc(MasterProfile.rating), asc(MasterProfile.id))
+    else:
+        raise ValueError(f"Неизвестное направление пагинации: {direction}")
+    return stmt.limit(1)
+
+
+async def fetch_master_page(session: AsyncSession, direction: str = 'first',
+                            cursor: Optional[tuple[Decimal, int]] = None,
+                            city: Optional[str] = None) -> Optional[MasterProfile]:
+    return await session.scalar(master_page_stmt(direction, cursor, city))
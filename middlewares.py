@@ -1,11 +1,52 @@
-from typing import Callable, Dict, Any, Awaitable
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, Awaitable, Optional, List
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from aiogram.types import TelegramObject, Update
+from aiogram.types import User as TelegramUser
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from cache import TTLCache
+from config import settings
+from database import User, MasterProfile
+
+
+class LazySession:
+    """
+    Прокси над AsyncSession, который открывает сессию только при первом обращении.
+
+    Хендлеры работают с ним как с обычной сессией (session.scalar, session.commit, ...).
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self._session_pool = session_pool
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def is_used(self) -> bool:
+        return self._session is not None
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get_session(), name)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
 
 class DbSessionMiddleware(BaseMiddleware):
     def __init__(self, session_pool: async_sessionmaker):
         self.session_pool = session_pool
+        # Счетчики для мониторинга: сколько апдейтов реально потребовали сессию
+        self.updates_total = 0
+        self.sessions_opened = 0
 
     async def __call__(
         self,
@@ -13,6 +54,107 @@ class DbSessionMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data["session"] = session
-            return await handler(event, data)
\ No newline at end of file
+        session = LazySession(self.session_pool)
+        data["session"] = session
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
+            self.updates_total += 1
+            if session.is_used:
+                self.sessions_opened += 1
+            update_id = event.update_id if isinstance(event, Update) else None
+            logging.debug(f"Апдейт {update_id}: сессия БД {'использована' if session.is_used else 'не понадобилась'}")
+
+
+# --- ТЕКУЩИЙ ПОЛЬЗОВАТЕЛЬ ---
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Снимок строки User, который безопасно переиспользовать между сессиями."""
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    full_name: str
+    role: str
+
+
+@dataclass(frozen=True)
+class CachedMaster:
+    """Снимок строки MasterProfile текущего пользователя."""
+    id: int
+    user_id: int
+    city: Optional[str]
+    description: Optional[str]
+    social_links: Optional[List[dict]]
+    is_active: bool
+
+
+user_cache = TTLCache(ttl=settings.user_cache_ttl, maxsize=settings.user_cache_size)
+
+
+def invalidate_user(telegram_id: int) -> None:
+    """Сбрасывает кэш пользователя после изменения его роли или профиля мастера."""
+    user_cache.invalidate(telegram_id)
+
+
+class CurrentUserMiddleware(BaseMiddleware):
+    """
+    Один раз за апдейт находит пользователя (и его профиль мастера) и передает
+    их в хендлеры как db_user и db_master. Новые пользователи регистрируются автоматически.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        from_user: Optional[TelegramUser] = data.get("event_from_user")
+        if from_user is not None:
+            cached = user_cache.get(from_user.id)
+            if cached is None:
+                cached = await self._load(data["session"], from_user)
+                user_cache.set(from_user.id, cached)
+            data["db_user"], data["db_master"] = cached
+        return await handler(event, data)
+
+    @staticmethod
+    async def _load(session: AsyncSession, from_user: TelegramUser) -> tuple[CachedUser, Optional[CachedMaster]]:
+        stmt = (
+            select(User, MasterProfile)
+            .outerjoin(MasterProfile, MasterProfile.user_id == User.id)
+            .where(User.telegram_id == from_user.id)
+        )
+        row = (await session.execute(stmt)).first()
+        if row is None:
+            user = User(telegram_id=from_user.id, username=from_user.username, full_name=from_user.full_name)
+            session.add(user)
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Параллельный апдейт того же пользователя успел его зарегистрировать
+                await session.rollback()
+                row = (await session.execute(stmt)).one()
+            else:
+                row = (user, None)
+
+        user, master_profile = row
+        db_user = CachedUser(
+            id=user.id,
+            telegram_id=user.telegram_id,
+            username=user.username,
+            full_name=user.full_name,
+            role=user.role,
+        )
+        db_master = None
+        if master_profile is not None:
+            db_master = CachedMaster(
+                id=master_profile.id,
+                user_id=master_profile.user_id,
+                city=master_profile.city,
+                description=master_profile.description,
+                social_links=master_profile.social_links,
+                is_active=master_profile.is_active,
+            )
+        return db_user, db_master
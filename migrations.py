@@ -0,0 +1,199 @@
+# migrations.py
+#
+# Версионные миграции схемы. Запускаются при старте бота и обновляют
+# существующую базу (например, tattoo_bot.db) на месте.
+#
+# Новая миграция добавляется в конец MIGRATIONS со следующим номером версии.
+# Миграции пишутся явным SQL, а не через модели: модели со временем меняются,
+# а миграция должна выполнять ровно то, что делала в момент написания.
+
+import logging
+import math
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import Connection, inspect, text, select, insert, Table, Column, Integer, String, DateTime, MetaData, func
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from database import Base, engine as default_engine
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+_version_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255)),
+    Column('applied_at', DateTime, server_default=func.now()),
+)
+
+
+def _columns(conn: Connection, table: str) -> set[str]:
+    return {column['name'] for column in inspect(conn).get_columns(table)}
+
+
+# --- МИГРАЦИИ ---
+
+def _add_comments_count(conn: Connection) -> None:
+    if 'comments_count' not in _columns(conn, 'tattoo_works'):
+        conn.execute(text("ALTER TABLE tattoo_works ADD COLUMN comments_count INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE tattoo_works SET comments_count = "
+        "(SELECT COUNT(*) FROM comments WHERE comments.work_id = tattoo_works.id)"
+    ))
+
+
+def _add_hot_query_indexes(conn: Connection) -> None:
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_tattoo_works_status_id ON tattoo_works (status, id)",
+        "CREATE INDEX IF NOT EXISTS ix_tattoo_works_status_category_id_id ON tattoo_works (status, category_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_tattoo_works_master_id_id ON tattoo_works (master_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_reviews_master_id_id ON reviews (master_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_comments_work_id_created_at ON comments (work_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_master_profiles_user_id ON master_profiles (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_master_profiles_is_active_rating ON master_profiles (is_active, rating)",
+        "CREATE INDEX IF NOT EXISTS ix_likes_work_id ON likes (work_id)",
+    ):
+        conn.execute(text(statement))
+
+
+def _fill_null_ratings(conn: Connection) -> None:
+    # Каталог мастеров листается по ключу (rating, id), NULL в нем ломает сравнение
+    conn.execute(text("UPDATE master_profiles SET rating = 0 WHERE rating IS NULL"))
+
+
+def _comments_keyset_index(conn: Connection) -> None:
+    # Пагинация комментариев идет по ключу (created_at, id)
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_comments_work_id_created_at_id ON comments (work_id, created_at, id)"
+    ))
+    conn.execute(text("DROP INDEX IF EXISTS ix_comments_work_id_created_at"))
+
+
+def _add_rating_aggregates(conn: Connection) -> None:
+    columns = _columns(conn, 'master_profiles')
+    for column in ('rating_sum', 'rating_count'):
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE master_profiles ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE master_profiles SET "
+        "rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM reviews WHERE reviews.master_id = master_profiles.id), "
+        "rating_count = (SELECT COUNT(*) FROM reviews WHERE reviews.master_id = master_profiles.id), "
+        "rating = (SELECT COALESCE(ROUND(AVG(rating), 2), 0) FROM reviews WHERE reviews.master_id = master_profiles.id)"
+    ))
+
+
+def _invoice_id_index(conn: Connection) -> None:
+    # Вебхук Crypto Pay находит работу по invoice_id
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_tattoo_works_invoice_id ON tattoo_works (invoice_id)"))
+
+
+def _backfill_payments(conn: Connection) -> None:
+    # Таблицу payments создает create_all; переносим в нее счета уже созданных работ.
+    # Размещение работы стоило фиксированные 1 USDT. Время пишем в формате SQLAlchemy
+    # (с микросекундами), как у новых платежей, иначе ключ (created_at, id) сравнивается неверно.
+    conn.execute(text(
+        "INSERT INTO payments (invoice_id, kind, user_id, work_id, amount, asset, status, created_at, paid_at) "
+        "SELECT tw.invoice_id, 'work_placement', mp.user_id, tw.id, 1, 'USDT', "
+        "       CASE WHEN tw.status = 'pending_payment' THEN 'active' ELSE 'paid' END, "
+        "       strftime('%Y-%m-%d %H:%M:%S.000000', tw.created_at), "
+        "       CASE WHEN tw.status = 'pending_payment' THEN NULL "
+        "            ELSE strftime('%Y-%m-%d %H:%M:%S.000000', tw.created_at) END "
+        "FROM tattoo_works tw JOIN master_profiles mp ON mp.id = tw.master_id "
+        "WHERE tw.invoice_id IS NOT NULL "
+        "AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.invoice_id = tw.invoice_id)"
+    ))
+
+
+def _normalize_comment_timestamps(conn: Connection) -> None:
+    # func.now() писал время без дробной части; приводим к формату SQLAlchemy,
+    # иначе курсор (created_at, id) не совпадает с комментариями той же секунды
+    conn.execute(text(
+        "UPDATE comments SET created_at = strftime('%Y-%m-%d %H:%M:%S.000000', created_at) "
+        "WHERE length(created_at) = 19"
+    ))
+
+
+def _add_work_scores(conn: Connection) -> None:
+    columns = _columns(conn, 'tattoo_works')
+    for column in ('popular_score', 'trending_score'):
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE tattoo_works ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+    # Формула ranking.py на момент написания: лайк — 1, комментарий — 2;
+    # тренд = (log10(max(счет, 1)) + секунды с 2024-01-01 / 45000) * 10000
+    rows = conn.execute(text(
+        "SELECT id, likes_count + 2 * comments_count, "
+        "       CAST(strftime('%s', created_at) AS INTEGER) - CAST(strftime('%s', '2024-01-01') AS INTEGER) "
+        "FROM tattoo_works"
+    )).all()
+    scores = [
+        {'id': work_id, 'popular': popular,
+         'trending': round((math.log10(max(popular, 1)) + (seconds or 0) / 45000) * 10000)}
+        for work_id, popular, seconds in rows
+    ]
+    if scores:
+        conn.execute(text("UPDATE tattoo_works SET popular_score = :popular, trending_score = :trending "
+                          "WHERE id = :id"), scores)
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_tattoo_works_status_popular_score_id "
+        "ON tattoo_works (status, popular_score, id)",
+        "CREATE INDEX IF NOT EXISTS ix_tattoo_works_status_trending_score_id "
+        "ON tattoo_works (status, trending_score, id)",
+    ):
+        conn.execute(text(statement))
+
+
+def _add_broadcast_lease(conn: Connection) -> None:
+    columns = _columns(conn, 'broadcasts')
+    if 'owner' not in columns:
+        conn.execute(text("ALTER TABLE broadcasts ADD COLUMN owner VARCHAR(100)"))
+    if 'heartbeat_at' not in columns:
+        conn.execute(text("ALTER TABLE broadcasts ADD COLUMN heartbeat_at DATETIME"))
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "tattoo_works.comments_count", _add_comments_count),
+    Migration(2, "индексы для частых запросов", _add_hot_query_indexes),
+    Migration(3, "master_profiles.rating без NULL", _fill_null_ratings),
+    Migration(4, "индекс comments (work_id, created_at, id)", _comments_keyset_index),
+    Migration(5, "master_profiles.rating_sum / rating_count", _add_rating_aggregates),
+    Migration(6, "индекс tattoo_works (invoice_id)", _invoice_id_index),
+    Migration(7, "журнал платежей payments", _backfill_payments),
+    Migration(8, "comments.created_at с микросекундами", _normalize_comment_timestamps),
+    Migration(9, "tattoo_works.popular_score / trending_score", _add_work_scores),
+    Migration(10, "аренда рассылок broadcasts.owner / heartbeat_at", _add_broadcast_lease),
+]
+
+
+# --- ЗАПУСК ---
+
+def _upgrade(conn: Connection) -> list[int]:
+    is_fresh = not inspect(conn).has_table('users')
+
+    # Недостающие таблицы создаются по моделям сразу со всеми индексами
+    Base.metadata.create_all(conn)
+    _version_metadata.create_all(conn)
+
+    applied = set(conn.scalars(select(schema_migrations.c.version)))
+    pending = [m for m in MIGRATIONS if m.version not in applied]
+
+    for migration in pending:
+        # Пустая база уже создана по актуальным моделям — миграции только отмечаем
+        if not is_fresh:
+            logging.info(f"Применяю миграцию {migration.version}: {migration.description}")
+            migration.upgrade(conn)
+        conn.execute(insert(schema_migrations).values(version=migration.version, description=migration.description))
+
+    return [m.version for m in pending]
+
+
+async def run_migrations(engine: AsyncEngine = default_engine) -> list[int]:
+    """Создает недостающие таблицы и применяет новые миграции. Возвращает номера примененных версий."""
+    async with engine.begin() as conn:
+        return await conn.run_sync(_upgrade)
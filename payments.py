@@ -0,0 +1,339 @@
+# payments.py
+#
+# Подтверждение оплаты размещения работ и статуса мастера.
+#
+# Каждый выставленный счет Crypto Pay записывается в таблицу payments (журнал платежей).
+# Счет переходит из 'active' в 'paid' одним из трех путей:
+#  - вебхук Crypto Pay invoice_paid (основной, без исходящих запросов к API);
+#  - кнопка "Проверить оплату";
+#  - фоновая сверка: раз в settings.payment_reconcile_interval секунд бот запрашивает
+#    статусы всех активных счетов пачками через getInvoices (на случай потерянного вебхука).
+# Переход выполняется условным UPDATE, поэтому уведомления отправляет только первый из них.
+#
+# Счета выставляются на settings.crypto_invoice_ttl секунд. Более старые активные счета сверка
+# помечает 'expired' сама, не спрашивая API. Сверку ведет один воркер — владелец аренды
+# RECONCILER_LEASE.
+
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.types import ReplyKeyboardRemove
+from aiohttp import web
+from sqlalchemy import select, update, func, asc, desc, tuple_, Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from broadcast import notify_admins
+from config import settings
+from crypto_api import crypto_api, CryptoAPIUnavailable, verify_webhook_signature
+from database import async_session_factory, TattooWork, MasterProfile, User, Category, Payment, utcnow
+from keyboards import get_admin_moderation_kb
+from leases import acquire_lease, release_lease
+from states import MasterRegistration
+
+PAYMENT_WORK = 'work_placement'
+PAYMENT_MASTER_REG = 'master_registration'
+
+MASTER_REG_PAYLOAD_PREFIX = "master_reg:"
+
+# Формат created_at платежа в callback_data (без двоеточий — они разделяют поля)
+PAYMENT_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+# Сколько счетов запрашивать одним вызовом getInvoices (API отдает до 1000)
+INVOICES_BATCH_SIZE = 100
+
+RECONCILER_LEASE = 'payment_reconciler'
+
+_reconciler: Optional[asyncio.Task] = None
+
+
+# --- ЖУРНАЛ ПЛАТЕЖЕЙ ---
+
+def record_invoice(session: AsyncSession, invoice: dict, kind: str, user_id: int, amount: Decimal, asset: str,
+                   work_id: Optional[int] = None) -> Payment:
+    """Добавляет выставленный счет в журнал. Коммитит вызывающий — вместе с работой, если она есть."""
+    payment = Payment(invoice_id=invoice['invoice_id'], kind=kind, user_id=user_id, work_id=work_id,
+                      amount=amount, asset=asset, status='active')
+    session.add(payment)
+    return payment
+
+
+def _set_payment_status_stmt(invoice_id, status: str):
+    # Оплату принимаем и у счета, просроченного только по нашим часам (см. expire_stale_payments)
+    from_statuses = ('active', 'expired') if status == 'paid' else ('active',)
+    return (
+        update(Payment)
+        .where(Payment.invoice_id == invoice_id, Payment.status.in_(from_statuses))
+        .values(status=status, paid_at=utcnow() if status == 'paid' else None)
+    )
+
+
+async def mark_payment_paid(session: AsyncSession, invoice_id: int) -> bool:
+    """Отмечает счет оплаченным. False — его уже отметил кто-то другой."""
+    result = await session.execute(_set_payment_status_stmt(invoice_id, 'paid'))
+    await session.commit()
+    return result.rowcount == 1
+
+
+async def mark_work_paid(session: AsyncSession, work_id: int) -> bool:
+    """
+    Переводит работу из 'pending_payment' в 'pending_approval' и отмечает ее счет оплаченным.
+    Возвращает False, если работу уже перевел кто-то другой (вебхук, кнопка или фоновая сверка).
+    """
+    result = await session.execute(
+        update(TattooWork)
+        .where(TattooWork.id == work_id, TattooWork.status == 'pending_payment')
+        .values(status='pending_approval')
+    )
+    # Счет отмечаем в любом случае: работа могла уйти из 'pending_payment' раньше, чем журнал узнал об оплате
+    invoice_id = select(TattooWork.invoice_id).where(TattooWork.id == work_id).scalar_subquery()
+    await session.execute(_set_payment_status_stmt(invoice_id, 'paid'))
+    await session.commit()
+    return result.rowcount == 1
+
+
+async def notify_admins_new_work(bot: Bot, session: AsyncSession, work_id: int):
+    row = (await session.execute(
+        select(TattooWork, User.username, Category.name)
+        .join(MasterProfile, MasterProfile.id == TattooWork.master_id)
+        .join(User, User.id == MasterProfile.user_id)
+        .outerjoin(Category, Category.id == TattooWork.category_id)
+        .where(TattooWork.id == work_id)
+    )).first()
+    if row is None:
+        return
+    work, master_username, category_name = row
+
+    # Карточка собирается один раз и рассылается всем админам параллельно
+    send_card = partial(
+        bot.send_photo,
+        photo=work.image_file_id,
+        caption=f"Новая работа на модерацию!\n\n"
+                f"Мастер: @{master_username}\n"
+                f"Описание: {work.description}\n"
+                f"Стиль: {category_name or 'Не указан'}\n"
+                f"Цена: {work.price} руб.",
+        reply_markup=get_admin_moderation_kb(work.id),
+    )
+    await notify_admins(send_card)
+
+
+async def confirm_work_payment(bot: Bot, session: AsyncSession, work_id: int, master_telegram_id: int) -> bool:
+    """Подтверждает оплату работы и уведомляет админов и мастера. False — работа уже была подтверждена."""
+    if not await mark_work_paid(session, work_id):
+        return False
+    try:
+        await bot.send_message(master_telegram_id, f"✅ Оплата работы #{work_id} получена! "
+                                                   "Работа отправлена на модерацию.")
+    except Exception as e:
+        logging.error(f"Не удалось уведомить мастера {master_telegram_id} об оплате: {e}")
+    await notify_admins_new_work(bot, session, work_id)
+    return True
+
+
+def master_reg_payload(telegram_id: int) -> str:
+    return f"{MASTER_REG_PAYLOAD_PREFIX}{telegram_id}"
+
+
+def master_registration_state(bot: Bot, storage: BaseStorage, telegram_id: int) -> FSMContext:
+    return FSMContext(storage=storage, key=StorageKey(bot_id=bot.id, chat_id=telegram_id, user_id=telegram_id))
+
+
+async def confirm_master_registration(bot: Bot, storage: BaseStorage, session: AsyncSession,
+                                      invoice_id: int, telegram_id: int) -> bool:
+    """Отмечает оплату статуса мастера и переводит пользователя к заполнению профиля."""
+    if not await mark_payment_paid(session, invoice_id):
+        return False
+    await master_registration_state(bot, storage, telegram_id).set_state(MasterRegistration.waiting_for_city)
+    await bot.send_message(telegram_id, "✅ Оплата прошла успешно! Начинаем регистрацию.")
+    await bot.send_message(telegram_id, "Из какого вы города?", reply_markup=ReplyKeyboardRemove())
+    return True
+
+
+async def confirm_payment(bot: Bot, storage: BaseStorage, session: AsyncSession, payment: Payment,
+                          telegram_id: int) -> bool:
+    """Подтверждает оплаченный счет из журнала в зависимости от его назначения."""
+    if payment.kind == PAYMENT_WORK:
+        return await confirm_work_payment(bot, session, payment.work_id, telegram_id)
+    if payment.kind == PAYMENT_MASTER_REG:
+        return await confirm_master_registration(bot, storage, session, payment.invoice_id, telegram_id)
+    return False
+
+
+# --- ВЕБХУК CRYPTO PAY ---
+
+async def process_paid_invoice(bot: Bot, storage: BaseStorage, invoice: dict) -> bool:
+    """Обрабатывает оплаченный счет из вебхука. Возвращает True, если что-то было подтверждено."""
+    # Кнопка "Проверить оплату" после вебхука уже не пойдет в API
+    crypto_api.cache_invoice(invoice)
+
+    async with async_session_factory() as session:
+        row = (await session.execute(
+            select(Payment, User.telegram_id)
+            .join(User, User.id == Payment.user_id)
+            .where(Payment.invoice_id == invoice['invoice_id'])
+        )).first()
+        if row is None:
+            logging.warning(f"Вебхук Crypto Pay: счет {invoice['invoice_id']} не найден в журнале")
+            return False
+        payment, telegram_id = row
+        if payment.status == 'paid':
+            return False
+        return await confirm_payment(bot, storage, session, payment, telegram_id)
+
+
+def register_crypto_pay_webhook(app: web.Application, dp: Dispatcher, bot: Bot):
+    """Добавляет в aiohttp-приложение маршрут settings.crypto_pay_webhook_path для вебхуков Crypto Pay."""
+    token = settings.crypto_api_token.get_secret_value()
+
+    async def handle(request: web.Request) -> web.Response:
+        body = await request.read()
+        if not verify_webhook_signature(token, body, request.headers.get('crypto-pay-api-signature', '')):
+            logging.warning("Вебхук Crypto Pay с неверной подписью отклонен")
+            return web.Response(status=401)
+
+        event = json.loads(body)
+        invoice = event.get('payload') or {}
+        if event.get('update_type') == 'invoice_paid' and invoice.get('status') == 'paid':
+            try:
+                await process_paid_invoice(bot, dp.storage, invoice)
+            except Exception:
+                # Отвечаем 500, чтобы Crypto Pay повторил доставку
+                logging.exception(f"Ошибка обработки вебхука Crypto Pay {event.get('update_id')}")
+                return web.Response(status=500)
+        return web.json_response({"ok": True})
+
+    app.router.add_post(settings.crypto_pay_webhook_path, handle)
+
+
+# --- ФОНОВАЯ СВЕРКА ---
+
+async def expire_stale_payments(session: AsyncSession) -> int:
+    """
+    Помечает 'expired' активные счета старше срока оплаты без запроса к API. Запас в один интервал
+    сверки — чтобы последняя сверка успела увидеть оплату, сделанную перед самым истечением счета.
+    """
+    stale = utcnow() - timedelta(seconds=settings.crypto_invoice_ttl + settings.payment_reconcile_interval)
+    result = await session.execute(
+        update(Payment)
+        .where(Payment.status == 'active', Payment.created_at < stale)
+        .values(status='expired')
+    )
+    await session.commit()
+    return result.rowcount
+
+
+async def reconcile_payments(bot: Bot, storage: BaseStorage) -> int:
+    """Проверяет все активные счета журнала. Возвращает число подтвержденных платежей."""
+    confirmed = 0
+    cursor = None
+    async with async_session_factory() as session:
+        while True:
+            stmt = (
+                select(Payment, User.telegram_id)
+                .join(User, User.id == Payment.user_id)
+                .where(Payment.status == 'active')
+                .order_by(asc(Payment.created_at), asc(Payment.id))
+                .limit(INVOICES_BATCH_SIZE)
+            )
+            if cursor:
+                stmt = stmt.where(tuple_(Payment.created_at, Payment.id) > tuple_(*cursor))
+            rows = (await session.execute(stmt)).all()
+            if not rows:
+                break
+            cursor = (rows[-1].Payment.created_at, rows[-1].Payment.id)
+
+            invoices_data = await crypto_api.get_invoices(invoice_ids=[row.Payment.invoice_id for row in rows])
+            if not invoices_data:
+                continue
+            statuses = {item['invoice_id']: item['status'] for item in invoices_data.get('items', [])}
+
+            for payment, telegram_id in rows:
+                status = statuses.get(payment.invoice_id)
+                if status == 'paid':
+                    confirmed += await confirm_payment(bot, storage, session, payment, telegram_id)
+                elif status == 'expired':
+                    # Просроченный счет больше не проверяем
+                    await session.execute(_set_payment_status_stmt(payment.invoice_id, 'expired'))
+                    await session.commit()
+    return confirmed
+
+
+async def _reconcile_loop(bot: Bot, storage: BaseStorage, interval: int):
+    while True:
+        try:
+            async with async_session_factory() as session:
+                # Аренда с запасом на время самой сверки; владелец продлевает ее каждый проход
+                is_leader = await acquire_lease(session, RECONCILER_LEASE, interval * 3)
+                if is_leader:
+                    await expire_stale_payments(session)
+            confirmed = await reconcile_payments(bot, storage) if is_leader else 0
+            if confirmed:
+                logging.info(f"Сверка платежей: подтверждено платежей {confirmed}")
+        except CryptoAPIUnavailable:
+            logging.warning("Сверка платежей пропущена: Crypto Pay недоступен")
+        except Exception:
+            logging.exception("Ошибка сверки платежей")
+        await asyncio.sleep(interval)
+
+
+async def start_payment_reconciler(bot: Bot, dispatcher: Dispatcher):
+    global _reconciler
+    _reconciler = asyncio.create_task(
+        _reconcile_loop(bot, dispatcher.storage, settings.payment_reconcile_interval)
+    )
+
+
+async def stop_payment_reconciler():
+    global _reconciler
+    if _reconciler:
+        _reconciler.cancel()
+        try:
+            await _reconciler
+        except asyncio.CancelledError:
+            pass
+        _reconciler = None
+        async with async_session_factory() as session:
+            await release_lease(session, RECONCILER_LEASE)
+
+
+# --- ПРОСМОТР ДЛЯ АДМИНА ---
+
+def payment_cursor(payment: Payment) -> str:
+    return payment.created_at.strftime(PAYMENT_CURSOR_FORMAT)
+
+
+def parse_payment_cursor(created_at: str, payment_id: int) -> tuple[datetime, int]:
+    return datetime.strptime(created_at, PAYMENT_CURSOR_FORMAT), payment_id
+
+
+def paid_payments_page_stmt(direction: str = 'first', cursor: Optional[tuple[datetime, int]] = None) -> Select:
+    """Один оплаченный платеж в порядке (created_at DESC, id DESC); cursor — ключ текущего платежа."""
+    stmt = select(Payment).where(Payment.status == 'paid')
+    key = tuple_(Payment.created_at, Payment.id)
+
+    if direction == 'first':
+        stmt = stmt.order_by(desc(Payment.created_at), desc(Payment.id))
+    elif direction == 'next':
+        stmt = stmt.where(key < tuple_(*cursor)).order_by(desc(Payment.created_at), desc(Payment.id))
+    elif direction == 'prev':
+        stmt = stmt.where(key > tuple_(*cursor)).order_by(asc(Payment.created_at), asc(Payment.id))
+    else:
+        raise ValueError(f"Неизвестное направление пагинации: {direction}")
+    return stmt.limit(1)
+
+
+def revenue_stmt() -> Select:
+    """Сумма оплаченных счетов по валюте и назначению."""
+    return (
+        select(Payment.asset, Payment.kind, func.sum(Payment.amount))
+        .where(Payment.status == 'paid')
+        .group_by(Payment.asset, Payment.kind)
+    )
@@ -0,0 +1,55 @@
+# ranking.py
+#
+# Счет работ для сортировок галереи «Популярные» и «В тренде».
+#
+# Оба счета хранятся в tattoo_works и пересчитываются только когда меняются их входные данные:
+# при публикации работы, лайке и комментарии. Счет «В тренде» не зависит от текущего времени —
+# свежесть заложена в него через время создания работы (как в «hot» у Reddit): каждые
+# TRENDING_PERIOD секунд новизны весят как десятикратная вовлеченность. Поэтому старые счета
+# не нужно пересчитывать по расписанию, а галерея листается по индексу (счет, id).
+
+import math
+from datetime import datetime
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import TattooWork
+
+# Комментарий требует больше усилий, чем лайк
+COMMENT_WEIGHT = 2
+TRENDING_EPOCH = datetime(2024, 1, 1)
+TRENDING_PERIOD = 45_000
+# Счет «В тренде» хранится целым числом: он передается в callback_data как ключ пагинации
+TRENDING_SCALE = 10_000
+
+
+def popular_score(likes_count: int, comments_count: int) -> int:
+    return likes_count + COMMENT_WEIGHT * comments_count
+
+
+def trending_score(popular: int, created_at: datetime) -> int:
+    order = math.log10(max(popular, 1))
+    freshness = (created_at - TRENDING_EPOCH).total_seconds() / TRENDING_PERIOD
+    return round((order + freshness) * TRENDING_SCALE)
+
+
+def apply_work_scores(work: TattooWork) -> None:
+    """Пересчитывает счета загруженной работы; сохраняются вместе с ее изменением."""
+    work.popular_score = popular_score(work.likes_count, work.comments_count)
+    work.trending_score = trending_score(work.popular_score, work.created_at)
+
+
+async def refresh_work_scores(session: AsyncSession, work_id: int) -> None:
+    """Пересчитывает счета работы после UPDATE ее счетчиков, в той же транзакции."""
+    row = (await session.execute(
+        select(TattooWork.likes_count, TattooWork.comments_count, TattooWork.created_at)
+        .where(TattooWork.id == work_id)
+    )).first()
+    if row is None:
+        return
+    popular = popular_score(row.likes_count, row.comments_count)
+    await session.execute(
+        update(TattooWork).where(TattooWork.id == work_id)
+        .values(popular_score=popular, trending_score=trending_score(popular, row.created_at))
+    )
@@ -0,0 +1,27 @@
+# ratelimit.py
+
+import asyncio
+
+
+class RateLimiter:
+    """
+    Ограничивает число операций в секунду для всех корутин, использующих один экземпляр.
+
+    Слоты выдаются равномерно с интервалом 1 / rate. pause() сдвигает все будущие слоты —
+    так ответ Telegram "flood wait" притормаживает сразу всех отправителей, а не только одного.
+    """
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate
+        self._next_slot = 0.0
+
+    async def acquire(self) -> None:
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float) -> None:
+        resume_at = asyncio.get_running_loop().time() + seconds
+        self._next_slot = max(self._next_slot, resume_at)
@@ -0,0 +1,136 @@
+# settings_registry.py
+#
+# Настройки бота из таблицы bot_settings, которые админ меняет прямо в боте.
+#
+# Таблица читается целиком при запуске, дальше значения отдаются из памяти. Запись идет через
+# runtime_settings.set(): значение сохраняется в БД, а остальным воркерам через Redis pub/sub
+# уходит сигнал перечитать таблицу. Pub/sub включается вместе с fsm_storage='redis' —
+# с хранилищем в памяти бот работает одним процессом и сигнал не нужен.
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from aiogram import Dispatcher
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session_factory, BotSettings
+
+INVALIDATION_CHANNEL = 'bot_settings:invalidate'
+# Пауза перед повторной подпиской, если соединение с Redis оборвалось
+_RESUBSCRIBE_DELAY = 5
+
+
+@dataclass(frozen=True)
+class SettingSpec:
+    parse: Callable[[str], Any]
+    default: Any
+
+
+SPECS: dict[str, SettingSpec] = {
+    # Цена статуса мастера в USDT, 0 — регистрация бесплатная
+    'master_price': SettingSpec(int, 0),
+}
+
+
+class SettingsRegistry:
+    def __init__(self, specs: dict[str, SettingSpec]):
+        self._specs = specs
+        self._values: dict[str, Any] = {}
+        self._redis: Optional[Redis] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    def get(self, key: str) -> Any:
+        spec = self._specs[key]
+        return self._values.get(key, spec.default)
+
+    def _apply(self, raw: dict[str, str]) -> None:
+        values = {}
+        for key, value in raw.items():
+            spec = self._specs.get(key)
+            if spec is None:
+                continue
+            try:
+                values[key] = spec.parse(value)
+            except ValueError:
+                logging.error(f"Некорректное значение настройки {key}: {value!r}")
+        self._values = values
+
+    async def load(self, session: AsyncSession) -> None:
+        rows = await session.execute(select(BotSettings.key, BotSettings.value))
+        self._apply(dict(rows.all()))
+
+    async def reload(self) -> None:
+        async with async_session_factory() as session:
+            await self.load(session)
+
+    async def set(self, session: AsyncSession, key: str, value: Any) -> None:
+        """Сохраняет настройку в БД и оповещает остальные воркеры."""
+        spec = self._specs[key]
+        raw = str(value)
+        parsed = spec.parse(raw)
+
+        setting = await session.get(BotSettings, key)
+        if setting:
+            setting.value = raw
+        else:
+            session.add(BotSettings(key=key, value=raw))
+        await session.commit()
+
+        self._values = {**self._values, key: parsed}
+        if self._redis is not None:
+            try:
+                await self._redis.publish(INVALIDATION_CHANNEL, key)
+            except Exception as e:
+                # Остальные воркеры подхватят значение при переподписке
+                logging.error(f"Не удалось разослать изменение настройки {key}: {e}")
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    # Изменения, пропущенные пока подписки не было
+                    await self.reload()
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            await self.reload()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Подписка на изменения настроек прервана")
+                await asyncio.sleep(_RESUBSCRIBE_DELAY)
+
+    async def start(self, redis: Optional[Redis] = None) -> None:
+        await self.reload()
+        self._redis = redis
+        if redis is not None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        self._redis = None
+
+
+runtime_settings = SettingsRegistry(SPECS)
+
+
+# --- ЗАПУСК И ОСТАНОВКА БОТА ---
+
+async def start_settings_registry(dispatcher: Dispatcher) -> None:
+    redis = dispatcher.storage.redis if isinstance(dispatcher.storage, RedisStorage) else None
+    await runtime_settings.start(redis)
+
+
+async def stop_settings_registry() -> None:
+    await runtime_settings.stop()
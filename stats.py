@@ -0,0 +1,100 @@
+# stats.py
+#
+# Снимок статистики маркетплейса для админ-панели. Считается фоновой задачей
+# раз в settings.stats_refresh_interval секунд, экран статистики только читает готовый снимок.
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database import async_session_factory, User, TattooWork, Review
+from payments import revenue_stmt
+
+
+@dataclass(frozen=True)
+class MarketStats:
+    users_by_role: dict[str, int]
+    works_by_status: dict[str, int]
+    total_reviews: int
+    # Выручка по оплаченным счетам: {валюта: {назначение: сумма}}
+    revenue: dict[str, dict[str, Decimal]]
+    collected_at: datetime
+
+    @property
+    def total_users(self) -> int:
+        return sum(self.users_by_role.values())
+
+    @property
+    def total_works(self) -> int:
+        return sum(self.works_by_status.values())
+
+    @property
+    def age_seconds(self) -> int:
+        return int((datetime.now() - self.collected_at).total_seconds())
+
+
+_snapshot: Optional[MarketStats] = None
+_refresher: Optional[asyncio.Task] = None
+
+
+async def collect_stats(session: AsyncSession) -> MarketStats:
+    """Считает статистику: пользователи по ролям, работы по статусам, число отзывов и выручка."""
+    users = await session.execute(select(User.role, func.count()).group_by(User.role))
+    works = await session.execute(select(TattooWork.status, func.count()).group_by(TattooWork.status))
+    total_reviews = await session.scalar(select(func.count(Review.id)))
+    revenue: dict[str, dict[str, Decimal]] = {}
+    for asset, kind, amount in await session.execute(revenue_stmt()):
+        revenue.setdefault(asset, {})[kind] = Decimal(amount)
+    return MarketStats(
+        users_by_role=dict(users.all()),
+        works_by_status=dict(works.all()),
+        total_reviews=total_reviews or 0,
+        revenue=revenue,
+        collected_at=datetime.now(),
+    )
+
+
+async def refresh_stats(session: AsyncSession) -> MarketStats:
+    global _snapshot
+    _snapshot = await collect_stats(session)
+    return _snapshot
+
+
+async def get_stats(session: AsyncSession) -> MarketStats:
+    """Последний снимок; если фоновая задача еще не успела его посчитать — считает сразу."""
+    return _snapshot or await refresh_stats(session)
+
+
+# --- ФОНОВОЕ ОБНОВЛЕНИЕ ---
+
+async def _refresh_loop(interval: int) -> None:
+    while True:
+        try:
+            async with async_session_factory() as session:
+                await refresh_stats(session)
+        except Exception:
+            logging.exception("Не удалось обновить статистику")
+        await asyncio.sleep(interval)
+
+
+async def start_stats_refresher() -> None:
+    global _refresher
+    _refresher = asyncio.create_task(_refresh_loop(settings.stats_refresh_interval))
+
+
+async def stop_stats_refresher() -> None:
+    global _refresher
+    if _refresher:
+        _refresher.cancel()
+        try:
+            await _refresher
+        except asyncio.CancelledError:
+            pass
+        _refresher = None
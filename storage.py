@@ -0,0 +1,42 @@
+# storage.py
+
+from typing import Optional
+
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+from redis.asyncio import Redis, ConnectionPool
+
+from config import settings
+
+
+def create_redis(dsn: Optional[str] = None) -> Redis:
+    """Создает клиент Redis с общим пулом соединений."""
+    pool = ConnectionPool.from_url(
+        dsn or settings.redis_dsn,
+        max_connections=settings.redis_max_connections,
+        health_check_interval=30,
+    )
+    return Redis(connection_pool=pool)
+
+
+def create_fsm_storage(redis: Optional[Redis] = None) -> BaseStorage:
+    """
+    Возвращает хранилище FSM согласно настройке fsm_storage.
+
+    Клиент Redis можно передать явно (например, fakeredis в тестах),
+    иначе он будет создан по redis_dsn.
+    """
+    if settings.fsm_storage == 'memory':
+        return MemoryStorage()
+
+    if settings.fsm_storage == 'redis':
+        return RedisStorage(
+            redis=redis or create_redis(),
+            # with_bot_id позволяет нескольким ботам делить один Redis
+            key_builder=DefaultKeyBuilder(with_bot_id=True),
+            state_ttl=settings.fsm_state_ttl,
+            data_ttl=settings.fsm_data_ttl,
+        )
+
+    raise ValueError(f"Неизвестный тип хранилища FSM: {settings.fsm_storage}")
@@ -5,54 +5,40 @@ from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, ReplyKeyboardRemove, CallbackQuery, InputMediaPhoto
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
-from sqlalchemy import select, desc, asc, func, or_
+from sqlalchemy import select, update
 import logging
 from typing import Optional
 from math import ceil
+from decimal import Decimal
+from datetime import datetime
 
 from keyboards import (get_main_menu_kb, get_pagination_kb, WorkPaginationCallback,
                        MasterCallback, LikeCallback, ReviewCallback, get_rating_kb,
-                       get_work_filter_options_kb, get_category_filter_kb, WorkFilterCallback,
+                       get_work_filter_options_kb, WorkFilterCallback,
+                       WorkSortCallback, RankedWorkPaginationCallback,
                        get_master_search_options_kb, get_master_list_pagination_kb,
                        MasterSearchCallback, MasterListPagination, CommentCallback,
-                       get_comments_keyboard, CommentPaginationCallback)
-from database import (User, MasterProfile, TattooWork, Like, Review, Category,
-                      Comment, get_setting, BotSettings)
+                       get_comments_keyboard, CommentPaginationCallback, PaymentCallback, get_payment_kb)
+from database import (User, MasterProfile, TattooWork, Like, Review,
+                      Comment, Payment, apply_review_rating_stmt)
 from states import MasterRegistration, UserReviewing, UserMasterSearch, UserCommenting
-from crypto_api import CryptoAPI
-from config import settings
+from middlewares import CachedUser, invalidate_user
+from gallery import (fetch_work_card, fetch_gallery_card, invalidate_gallery_viewer, fetch_comments_page,
+                     comment_cursor, parse_comment_cursor)
+from categories import get_catalog
+from ranking import refresh_work_scores
+from masters import count_active_masters, fetch_master_page, invalidate_masters_count
+from crypto_api import crypto_api, CryptoAPIUnavailable
+from settings_registry import runtime_settings
+from payments import master_reg_payload, record_invoice, mark_payment_paid, PAYMENT_MASTER_REG
 
 router = Router()
-crypto_api = CryptoAPI(token=settings.crypto_api_token.get_secret_value())
-
-
-async def update_master_rating(master_id: int, session: AsyncSession):
-    """Пересчитывает и обновляет рейтинг мастера на основе всех его отзывов."""
-    avg_rating_result = await session.execute(
-        select(func.avg(Review.rating)).where(Review.master_id == master_id)
-    )
-    avg_rating = avg_rating_result.scalar_one_or_none()
-
-    master_profile = await session.get(MasterProfile, master_id)
-    if master_profile:
-        master_profile.rating = avg_rating if avg_rating is not None else 0
-        await session.commit()
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, session: AsyncSession):
-    user_result = await session.execute(select(User).where(User.telegram_id == message.from_user.id))
-    user = user_result.scalar_one_or_none()
-    if not user:
-        user = User(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            full_name=message.from_user.full_name
-        )
-        session.add(user)
-        await session.commit()
-    keyboard = get_main_menu_kb(user.role)
+async def cmd_start(message: Message, db_user: CachedUser):
+    # Новый пользователь уже зарегистрирован в CurrentUserMiddleware
+    keyboard = get_main_menu_kb(db_user.role)
     await message.answer(
         "Добро пожаловать в Тату Маркетплейс!",
         reply_markup=keyboard
@@ -62,25 +48,29 @@ async def cmd_start(message: Message, session: AsyncSession):
 # --- РЕГИСТРАЦИЯ МАСТЕРА ---
 
 @router.message(F.text == "⭐️ Стать мастером")
-async def start_master_reg(message: Message, state: FSMContext, session: AsyncSession):
-    user = await session.scalar(select(User).where(User.telegram_id = message.from_user.id))
-    if user and user.role == 'master':
+async def start_master_reg(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser):
+    if db_user.role == 'master':
         await message.answer("Вы уже являетесь мастером.")
         return
 
-    price_str = await get_setting(session, 'master_price', '0')
-    price = int(price_str)
+    price = runtime_settings.get('master_price')
 
     if price > 0:
-        invoice = await crypto_api.create_invoice(asset="USDT", amount=price)
+        try:
+            invoice = await crypto_api.create_invoice(asset="USDT", amount=price,
+                                                      payload=master_reg_payload(message.from_user.id))
+        except CryptoAPIUnavailable as e:
+            await message.answer(str(e))
+            return
         if invoice:
             await message.answer(
                 f"Стоимость получения статуса мастера: {price} USDT.\n\n"
                 "Пожалуйста, оплатите счет для продолжения регистрации.",
                 reply_markup=get_payment_kb(pay_url=invoice['pay_url'], work_id=0, invoice_id=invoice['invoice_id'])
             )
-            # Сохраняем invoice_id в FSM для проверки
-            await state.set_data({'master_reg_invoice_id': invoice['invoice_id']})
+            # Счет хранится в журнале платежей и переживает перезапуск бота
+            record_invoice(session, invoice, kind=PAYMENT_MASTER_REG, user_id=db_user.id, amount=price, asset="USDT")
+            await session.commit()
         else:
             await message.answer("Не удалось создать счет для оплаты. Попробуйте позже.")
     else:  # Бесплатная регистрация
@@ -91,20 +81,31 @@ async def start_master_reg(message: Message, state: FSMContext, session: AsyncSe
 # 👇 ДОБАВЬТЕ ЭТУ НОВУЮ ФУНКЦИЮ
 @router.callback_query(PaymentCallback.filter(F.work_id == 0))  # Используем work_id=0 как флаг для регистрации
 async def check_master_payment(query: CallbackQuery, callback_data: PaymentCallback, state: FSMContext,
-                               session: AsyncSession):
+                               session: AsyncSession, db_user: CachedUser):
     await query.answer("Проверяем оплату...")
 
-    state_data = await state.get_data()
-    expected_invoice_id = state_data.get('master_reg_invoice_id')
-
-    if not expected_invoice_id or expected_invoice_id != callback_data.invoice_id:
+    payment = await session.scalar(select(Payment).where(Payment.invoice_id == callback_data.invoice_id))
+    if not payment or payment.kind != PAYMENT_MASTER_REG or payment.user_id != db_user.id:
         await query.message.edit_text("Произошла ошибка с проверкой счета. Попробуйте снова.")
         return
 
-    invoices_data = await crypto_api.get_invoices(invoice_ids=[callback_data.invoice_id])
+    # Оплату уже подтвердил вебхук Crypto Pay или фоновая сверка (payments.py) — они же спросили город
+    if payment.status == 'paid':
+        await query.message.edit_text("✅ Оплата уже подтверждена.")
+        return
+
+    try:
+        invoices_data = await crypto_api.get_invoices(invoice_ids=[callback_data.invoice_id])
+    except CryptoAPIUnavailable as e:
+        # На колбэк уже ответили "Проверяем оплату...", второй ответ Telegram не примет
+        await query.message.answer(str(e))
+        return
     if invoices_data and invoices_data.get('items'):
         invoice = invoices_data['items'][0]
         if invoice['status'] == 'paid':
+            if not await mark_payment_paid(session, invoice['invoice_id']):
+                await query.message.edit_text("✅ Оплата уже подтверждена.")
+                return
             await query.message.edit_text("✅ Оплата прошла успешно! Начинаем регистрацию.")
             await state.set_state(MasterRegistration.waiting_for_city)
             await query.message.answer("Из какого вы города?", reply_markup=ReplyKeyboardRemove())
@@ -128,28 +129,27 @@ async def process_description(message: Message, state: FSMContext):
 
 
 @router.message(MasterRegistration.waiting_for_socials, F.text)
-async def process_socials(message: Message, state: FSMContext, session: AsyncSession):
+async def process_socials(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser):
     await state.update_data(socials=[{"name": "link", "url": message.text}])
     user_data = await state.get_data()
 
-    user = await session.scalar(select(User).where(User.telegram_id == message.from_user.id))
-
     new_master_profile = MasterProfile(
-        user_id=user.id,
+        user_id=db_user.id,
         city=user_data.get("city"),
         description=user_data.get("description"),
         social_links=user_data.get("socials")
     )
     session.add(new_master_profile)
 
-    user.role = 'master'
+    await session.execute(update(User).where(User.id == db_user.id).values(role='master'))
 
     await session.commit()
-    await session.refresh(user)
+    invalidate_user(db_user.telegram_id)
+    invalidate_masters_count()
 
     await state.clear()
 
-    keyboard = get_main_menu_kb(user_role=user.role)
+    keyboard = get_main_menu_kb(user_role='master')
     await message.answer(
         "🎉 Поздравляем! Вы стали мастером на нашей площадке. Ваш профиль создан.\n\n"
         "Теперь вам доступны новые функции.",
@@ -159,51 +159,33 @@ async def process_socials(message: Message, state: FSMContext, session: AsyncSes
 
 # --- ПРОСМОТР РАБОТ И ФИЛЬТРАЦИЯ ---
 
-async def show_work(message_or_query, session: AsyncSession, work_id: int = None, direction: str = 'first',
-                    category_id: Optional[int] = None, is_return: bool = False):
+async def show_work(message_or_query, session: AsyncSession, viewer_id: int, work_id: int = None,
+                    direction: str = 'first', category_id: Optional[int] = None, is_return: bool = False,
+                    sort: Optional[str] = None, score: Optional[int] = None):
     if isinstance(message_or_query, CallbackQuery):
         query = message_or_query
         message = query.message
-        user_id = query.from_user.id
     else:
         query = None
         message = message_or_query
-        user_id = message.from_user.id
-
-    base_stmt = select(TattooWork).options(
-        selectinload(TattooWork.category),
-        selectinload(TattooWork.master).selectinload(MasterProfile.user)
-    ).where(TattooWork.status == 'published')
 
-    if category_id:
-        base_stmt = base_stmt.where(TattooWork.category_id == category_id)
-
-    stmt = None
-    if is_return:
-        stmt = select(TattooWork).options(
-            selectinload(TattooWork.category),
-            selectinload(TattooWork.master).selectinload(MasterProfile.user)
-        ).where(TattooWork.id == work_id)
-    elif direction == 'first':
-        stmt = base_stmt.order_by(asc(TattooWork.id)).limit(1)
-    elif direction == 'next':
-        stmt = base_stmt.where(TattooWork.id > work_id).order_by(asc(TattooWork.id)).limit(1)
-    elif direction == 'prev':
-        stmt = base_stmt.where(TattooWork.id < work_id).order_by(desc(TattooWork.id)).limit(1)
-
-    if stmt is None:
-        logging.error(f"Неизвестное направление пагинации: {direction}")
+    try:
+        if is_return:
+            card = await fetch_work_card(session, viewer_id, work_id=work_id, direction='exact')
+        else:
+            card = await fetch_gallery_card(session, viewer_id, work_id=work_id, direction=direction,
+                                            category_id=category_id, sort=sort, score=score)
+    except ValueError as e:
+        logging.error(e)
         if query: await query.answer("Произошла ошибка!")
         return
 
-    work = await session.scalar(stmt)
-
-    if not work:
+    if not card:
         if direction == 'first':
             text = "В галерее пока нет ни одной работы."
             if category_id:
-                category = await session.get(Category, category_id)
-                text = f"В категории '{category.name}' пока нет работ."
+                catalog = await get_catalog(session)
+                text = f"В категории '{catalog.name(category_id)}' пока нет работ."
 
             if query:
                 await query.message.edit_text(text, reply_markup=None)
@@ -213,37 +195,28 @@ async def show_work(message_or_query, session: AsyncSession, work_id: int = None
             await query.answer("Это последняя работа в галерее.", show_alert=True)
         return
 
-    master_profile = await session.get(MasterProfile, work.master_id)
-    user_master = await session.get(User, master_profile.user_id)
-
-    current_user_db = await session.scalar(select(User).where(User.telegram_id == user_id))
-    is_liked = False
-    if current_user_db:
-        like = await session.scalar(select(Like).where(Like.user_id == current_user_db.id, Like.work_id == work.id))
-        is_liked = bool(like)
-
-    comments_count = await session.scalar(select(func.count(Comment.id)).where(Comment.work_id == work.id))
-
-    username = user_master.username if user_master.username else "скрыт"
-    category_name = work.category.name if work.category else "Не указан"
+    username = card.master_username if card.master_username else "скрыт"
+    category_name = card.category_name if card.category_name else "Не указан"
 
     caption = (
         f"<b>Стиль:</b> {category_name}\n"
-        f"<b>Описание:</b> {work.description}\n"
-        f"<b>Цена:</b> ~{int(work.price)} руб.\n\n"
+        f"<b>Описание:</b> {card.description}\n"
+        f"<b>Цена:</b> ~{int(card.price)} руб.\n\n"
         f"<b>Мастер:</b> @{username}"
     )
 
     keyboard = get_pagination_kb(
-        current_work_id=work.id,
-        master_id=master_profile.id,
-        likes_count=work.likes_count,
-        is_liked=is_liked,
-        comments_count=comments_count,
-        category_id=category_id
+        current_work_id=card.id,
+        master_id=card.master_id,
+        likes_count=card.likes_count,
+        is_liked=card.is_liked,
+        comments_count=card.comments_count,
+        category_id=category_id,
+        sort=sort,
+        score=card.score(sort)
     )
 
-    media = InputMediaPhoto(media=work.image_file_id, caption=caption)
+    media = InputMediaPhoto(media=card.image_file_id, caption=caption)
 
     if query:
         if query.message.photo:
@@ -262,21 +235,27 @@ async def browse_works_start(message: Message, session: AsyncSession):
 
 
 @router.callback_query(WorkFilterCallback.filter(F.action == "show_all"))
-async def filter_show_all(query: CallbackQuery, session: AsyncSession):
-    await show_work(query, session, direction='first', category_id=None)
+async def filter_show_all(query: CallbackQuery, session: AsyncSession, db_user: CachedUser):
+    await show_work(query, session, db_user.id, direction='first', category_id=None)
+
+
+@router.callback_query(WorkSortCallback.filter())
+async def filter_sorted(query: CallbackQuery, callback_data: WorkSortCallback, session: AsyncSession,
+                        db_user: CachedUser):
+    await show_work(query, session, db_user.id, direction='first', sort=callback_data.sort)
 
 
 @router.callback_query(WorkFilterCallback.filter(F.action == "by_style"))
 async def filter_by_style(query: CallbackQuery, session: AsyncSession):
-    categories = await session.scalars(select(Category).order_by(Category.name))
-    await query.message.edit_text("Выберите стиль для фильтрации:",
-                                  reply_markup=get_category_filter_kb(list(categories)))
+    catalog = await get_catalog(session)
+    await query.message.edit_text("Выберите стиль для фильтрации:", reply_markup=catalog.filter_kb)
     await query.answer()
 
 
 @router.callback_query(WorkFilterCallback.filter(F.action == "select_style"))
-async def filter_select_style(query: CallbackQuery, callback_data: WorkFilterCallback, session: AsyncSession):
-    await show_work(query, session, direction='first', category_id=callback_data.category_id)
+async def filter_select_style(query: CallbackQuery, callback_data: WorkFilterCallback, session: AsyncSession,
+                              db_user: CachedUser):
+    await show_work(query, session, db_user.id, direction='first', category_id=callback_data.category_id)
 
 
 @router.callback_query(WorkFilterCallback.filter(F.action == "back_to_options"))
@@ -287,13 +266,15 @@ async def filter_back_to_options(query: CallbackQuery):
 
 
 @router.callback_query(WorkPaginationCallback.filter())
-async def browse_works_paginated(query: CallbackQuery, callback_data: WorkPaginationCallback, session: AsyncSession):
+async def browse_works_paginated(query: CallbackQuery, callback_data: WorkPaginationCallback, session: AsyncSession,
+                                 db_user: CachedUser):
     is_return = callback_data.action == "return_to_work"
 
     if is_return:
         await show_work(
             query,
             session,
+            db_user.id,
             work_id=callback_data.current_work_id,
             is_return=True
         )
@@ -301,12 +282,21 @@ async def browse_works_paginated(query: CallbackQuery, callback_data: WorkPagina
         await show_work(
             query,
             session,
+            db_user.id,
             work_id=callback_data.current_work_id,
             direction=callback_data.action,
             category_id=callback_data.category_id
         )
 
 
+@router.callback_query(RankedWorkPaginationCallback.filter())
+async def browse_ranked_works(query: CallbackQuery, callback_data: RankedWorkPaginationCallback,
+                              session: AsyncSession, db_user: CachedUser):
+    await show_work(query, session, db_user.id, work_id=callback_data.current_work_id,
+                    direction=callback_data.action, category_id=callback_data.category_id,
+                    sort=callback_data.sort, score=callback_data.score)
+
+
 # --- ПРОСМОТР И ПОИСК МАСТЕРОВ ---
 
 async def build_master_card_text(master_profile: MasterProfile, user_master: User) -> str:
@@ -326,19 +316,24 @@ async def build_master_card_text(master_profile: MasterProfile, user_master: Use
     return text
 
 
-async def show_masters_list(message: types.Message, session: AsyncSession, page: int = 1, city: Optional[str] = None):
-    """Отображает список мастеров с пагинацией."""
-    per_page = 1
-    offset = (page - 1) * per_page
+async def show_masters_list(message: types.Message, session: AsyncSession, page: int = 1, city: Optional[str] = None,
+                            direction: str = 'first', cursor: Optional[tuple[Decimal, int]] = None) -> bool:
+    """Отображает список мастеров с пагинацией по ключу (rating, id). Возвращает False, если листать дальше некуда."""
+    if cursor is None:
+        # Кнопка без ключа страницы (старого формата) — начинаем список заново
+        page, direction = 1, 'first'
+    total_masters = await count_active_masters(session, city)
 
-    base_query = select(MasterProfile).join(User).where(MasterProfile.is_active == True).options(selectinload(MasterProfile.user))
-    if city:
-        base_query = base_query.where(func.lower(MasterProfile.city) == city.lower())
+    master_profile = None
+    if total_masters:
+        master_profile = await fetch_master_page(session, direction=direction, cursor=cursor, city=city)
 
-    count_query = select(func.count()).select_from(base_query.subquery())
-    total_masters = await session.scalar(count_query)
+    if not master_profile and direction != 'first':
+        # Счетчик устарел: мастер, на которого указывала страница, уже недоступен
+        invalidate_masters_count()
+        return False
 
-    if total_masters == 0:
+    if not master_profile:
         text = "Мастера не найдены."
         if city:
             text = f"Мастера из города '{city}' не найдены."
@@ -346,22 +341,21 @@ async def show_masters_list(message: types.Message, session: AsyncSession, page:
             await message.edit_text(text, reply_markup=None)
         else:
             await message.answer(text, reply_markup=None)
-        return
+        return True
 
-    total_pages = ceil(total_masters / per_page)
+    # Счетчик может отставать от реального числа мастеров, поэтому страница не выходит за его пределы
+    total_pages = max(total_masters, page)
 
-    masters_query = base_query.order_by(desc(MasterProfile.rating)).limit(per_page).offset(offset)
-    master_profile = await session.scalar(masters_query)
+    card_text = await build_master_card_text(master_profile, master_profile.user)
 
-    user_master = await session.get(User, master_profile.user_id)
-    card_text = await build_master_card_text(master_profile, user_master)
-
-    keyboard = get_master_list_pagination_kb(total_pages, page, city)
+    keyboard = get_master_list_pagination_kb(total_pages, page, cursor_rating=f"{master_profile.rating or 0:.2f}",
+                                             cursor_id=master_profile.id, city=city)
 
     if hasattr(message, 'edit_text'):
         await message.edit_text(card_text, reply_markup=keyboard, disable_web_page_preview=True)
     else:
         await message.answer(card_text, reply_markup=keyboard, disable_web_page_preview=True)
+    return True
 
 
 @router.message(F.text == "👥 Просмотр мастеров")
@@ -390,62 +384,73 @@ async def search_masters_by_city_process(message: Message, state: FSMContext, se
 
 @router.callback_query(MasterListPagination.filter())
 async def masters_list_paginated(query: CallbackQuery, callback_data: MasterListPagination, session: AsyncSession):
-    await show_masters_list(query.message, session, page=callback_data.page, city=callback_data.city)
+    cursor = None
+    if callback_data.rating is not None and callback_data.master_id is not None:
+        cursor = (Decimal(callback_data.rating), callback_data.master_id)
+    shown = await show_masters_list(query.message, session, page=callback_data.page, city=callback_data.city,
+                                    direction=callback_data.action, cursor=cursor)
+    if not shown:
+        await query.answer("Это крайний мастер в списке.", show_alert=True)
+        return
     await query.answer()
 
 
 # --- ЛАЙКИ И ОТЗЫВЫ ---
 
 @router.callback_query(LikeCallback.filter(F.action == "toggle"))
-async def toggle_like(query: CallbackQuery, callback_data: LikeCallback, session: AsyncSession):
-    user = await session.scalar(select(User).where(User.telegram_id == query.from_user.id))
+async def toggle_like(query: CallbackQuery, callback_data: LikeCallback, session: AsyncSession, db_user: CachedUser):
     work = await session.get(TattooWork, callback_data.work_id)
 
-    if not user or not work:
-        await query.answer("Ошибка: пользователь или работа не найдены.", show_alert=True)
+    if not work:
+        await query.answer("Ошибка: работа не найдена.", show_alert=True)
         return
 
-    current_category_id = None
+    # Фильтр, сортировку и позицию в ленте берем из кнопки "➡️", чтобы листание продолжилось с того же места
+    current_category_id, sort, score = None, None, None
     if query.message.reply_markup:
         for row in query.message.reply_markup.inline_keyboard:
             for button in row:
-                if button.callback_data and button.callback_data.startswith("work_pag:next"):
-                    try:
-                        parts = button.callback_data.split(':')
-                        if len(parts) > 3 and parts[3] and parts[3] != 'None':
-                            current_category_id = int(parts[3])
-                    except (ValueError, IndexError):
-                        pass
-                    break
-            if current_category_id is not None:
-                break
-
-    like = await session.scalar(select(Like).where(Like.user_id == user.id, Like.work_id == work.id))
+                try:
+                    if button.callback_data and button.callback_data.startswith("work_pag:next"):
+                        current_category_id = WorkPaginationCallback.unpack(button.callback_data).category_id
+                    elif button.callback_data and button.callback_data.startswith("work_rank:next"):
+                        cursor = RankedWorkPaginationCallback.unpack(button.callback_data)
+                        current_category_id, sort, score = cursor.category_id, cursor.sort, cursor.score
+                except (ValueError, TypeError):
+                    pass
+
+    like = await session.scalar(select(Like).where(Like.user_id == db_user.id, Like.work_id == work.id))
 
     if like:
         await session.delete(like)
-        work.likes_count -= 1
         is_liked_new = False
         await query.answer("Лайк убран")
     else:
-        new_like = Like(user_id=user.id, work_id=work.id)
+        new_like = Like(user_id=db_user.id, work_id=work.id)
         session.add(new_like)
-        work.likes_count += 1
         is_liked_new = True
         await query.answer("❤️")
 
+    # Счетчик меняем атомарно, как при комментировании: лайки других воркеров не теряются
+    await session.execute(
+        update(TattooWork).where(TattooWork.id == work.id)
+        .values(likes_count=TattooWork.likes_count + (1 if is_liked_new else -1))
+    )
+    await refresh_work_scores(session, work.id)
+    # Актуальные счетчики для клавиатуры
+    await session.refresh(work, ['likes_count', 'comments_count'])
     await session.commit()
-
-    # --- ИСПРАВЛЕНИЕ: ДОБАВЛЯЕМ ПОЛУЧЕНИЕ СЧЕТЧИКА КОММЕНТАРИЕВ ---
-    comments_count = await session.scalar(select(func.count(Comment.id)).where(Comment.work_id == work.id))
+    invalidate_gallery_viewer(db_user.id)
 
     keyboard = get_pagination_kb(
         current_work_id=work.id,
         master_id=work.master_id,
         likes_count=work.likes_count,
         is_liked=is_liked_new,
-        comments_count=comments_count,
-        category_id=current_category_id
+        comments_count=work.comments_count,
+        category_id=current_category_id,
+        sort=sort,
+        score=score
     )
     await query.message.edit_reply_markup(reply_markup=keyboard)
 
@@ -475,24 +480,21 @@ async def process_rating(query: CallbackQuery, state: FSMContext):
 
 
 @router.message(UserReviewing.waiting_for_text, F.text)
-async def process_review_text(message: Message, state: FSMContext, session: AsyncSession):
+async def process_review_text(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser):
     review_text = message.text
     user_data = await state.get_data()
 
-    current_user = await session.scalar(select(User).where(User.telegram_id == message.from_user.id))
-
     new_review = Review(
         work_id=user_data.get("work_id"),
         master_id=user_data.get("master_id"),
-        client_id=current_user.id,
+        client_id=db_user.id,
         rating=user_data.get("rating"),
         text=review_text
     )
     session.add(new_review)
+    await session.execute(apply_review_rating_stmt(new_review.master_id, new_review.rating))
     await session.commit()
 
-    await update_master_rating(user_data.get("master_id"), session)
-
     await state.clear()
     await message.answer("✅ Спасибо! Ваш отзыв был успешно оставлен.")
 
@@ -511,64 +513,72 @@ async def start_commenting(query: CallbackQuery, callback_data: CommentCallback,
 
 
 @router.message(UserCommenting.waiting_for_comment_text, F.text)
-async def process_comment_text(message: Message, state: FSMContext, session: AsyncSession):
+async def process_comment_text(message: Message, state: FSMContext, session: AsyncSession, db_user: CachedUser):
     data = await state.get_data()
     work_id = data.get("work_id")
 
-    user = await session.scalar(select(User).where(User.telegram_id == message.from_user.id))
-
     new_comment = Comment(
         work_id=work_id,
-        user_id=user.id,
+        user_id=db_user.id,
         text=message.text
     )
     session.add(new_comment)
+    await session.execute(
+        update(TattooWork).where(TattooWork.id == work_id).values(comments_count=TattooWork.comments_count + 1)
+    )
+    await refresh_work_scores(session, work_id)
     await session.commit()
+    invalidate_gallery_viewer(db_user.id)
     await state.clear()
 
     await message.answer("✅ Ваш комментарий добавлен.")
 
-    await show_work(message, session, work_id=work_id, is_return=True)
+    await show_work(message, session, db_user.id, work_id=work_id, is_return=True)
 
 
-async def show_comments(query: CallbackQuery, session: AsyncSession, work_id: int, page: int = 1):
-    total_comments_count = await session.scalar(select(func.count(Comment.id)).where(Comment.work_id == work_id))
+async def show_comments(query: CallbackQuery, session: AsyncSession, work_id: int, page: int = 1,
+                        direction: str = 'first', cursor: Optional[tuple[datetime, int]] = None):
+    if cursor is None:
+        # Кнопка без ключа страницы (старого формата) — показываем первую страницу
+        page, direction = 1, 'first'
+    total_comments_count = await session.scalar(select(TattooWork.comments_count).where(TattooWork.id == work_id)) or 0
     total_pages = ceil(total_comments_count / COMMENTS_PER_PAGE)
 
     text = f"<b>Комментарии к работе #{work_id} (Страница {page}/{total_pages})</b>\n\n"
 
+    comments = []
     if total_pages == 0 and page == 1:
         text = "Комментариев пока нет."
     else:
-        offset = (page - 1) * COMMENTS_PER_PAGE
-        comments_result = await session.execute(
-            select(Comment)
-            .where(Comment.work_id == work_id)
-            .options(selectinload(Comment.user))
-            .order_by(desc(Comment.created_at))
-            .limit(COMMENTS_PER_PAGE)
-            .offset(offset)
-        )
-        comments = comments_result.scalars().all()
+        comments = await fetch_comments_page(session, work_id, COMMENTS_PER_PAGE, direction=direction, cursor=cursor)
+        if not comments and direction != 'first':
+            await query.answer("Это крайняя страница комментариев.", show_alert=True)
+            return
 
         for comment in comments:
             username = comment.user.username or f"user{comment.user.telegram_id}"
             text += f"👤 <b>@{username}</b>: <i>{comment.text}</i>\n\n"
 
+    keyboard = get_comments_keyboard(
+        work_id, total_pages, page,
+        first_cursor=comment_cursor(comments[0]) if comments else None,
+        last_cursor=comment_cursor(comments[-1]) if comments else None
+    )
+
     # Проверяем, есть ли у сообщения фото, чтобы избежать ошибки при редактировании
     if query.message.photo:
         # Если это было сообщение с фото, удаляем его и отправляем новое текстовое
         await query.message.delete()
         await query.message.answer(
             text,
-            reply_markup=get_comments_keyboard(work_id, total_pages, page),
+            reply_markup=keyboard,
             disable_web_page_preview=True
         )
     else:
         # Если это уже было текстовое сообщение (пагинация), редактируем его
         await query.message.edit_text(
             text,
-            reply_markup=get_comments_keyboard(work_id, total_pages, page),
+            reply_markup=keyboard,
             disable_web_page_preview=True
         )
     await query.answer()
@@ -581,7 +591,11 @@ async def view_comments(query: CallbackQuery, callback_data: CommentCallback, se
 
 @router.callback_query(CommentPaginationCallback.filter())
 async def paginate_comments(query: CallbackQuery, callback_data: CommentPaginationCallback, session: AsyncSession):
-    await show_comments(query, session, work_id=callback_data.work_id, page=callback_data.page)
+    cursor = None
+    if callback_data.created_at is not None and callback_data.comment_id is not None:
+        cursor = parse_comment_cursor(callback_data.created_at, callback_data.comment_id)
+    await show_comments(query, session, work_id=callback_data.work_id, page=callback_data.page,
+                        direction=callback_data.action, cursor=cursor)
 
 
 # --- ПРОФИЛЬ МАСТЕРА (ОБЩИЙ ПРОСМОТР) ---
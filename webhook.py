@@ -0,0 +1,151 @@
+# webhook.py
+
+import asyncio
+import logging
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import settings
+from payments import register_crypto_pay_webhook
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука Telegram с ограничением одновременно обрабатываемых апдейтов.
+
+    Апдейт принимается только если есть свободный слот. Если все слоты заняты
+    дольше acquire_timeout, отвечаем 503 — Telegram повторит доставку позже,
+    а очередь в памяти процесса не растет.
+
+    Переопределен только публичный handle(): фоновую обработку апдейта класс ведет сам,
+    не опираясь на приватные методы BaseRequestHandler.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int, acquire_timeout: float,
+                 secret_token: str | None = None, **data: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.max_concurrency = max_concurrency
+        self.acquire_timeout = acquire_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Вебхук перегружен ({self.in_flight}/{self.max_concurrency}), апдейт отклонен")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+
+        try:
+            update = Update.model_validate(await request.json(loads=bot.session.json_loads), context={"bot": bot})
+        except Exception:
+            self._semaphore.release()
+            raise
+
+        # Слот освобождает _feed_update по завершении обработки
+        task = asyncio.create_task(self._feed_update(bot=bot, update=update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed_update(self, bot: Bot, update: Update) -> None:
+        try:
+            result = await self.dispatcher.feed_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        except Exception as e:
+            logging.exception(f"Ошибка при обработке апдейта {update.update_id}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def close(self) -> None:
+        # Даем уже принятым апдейтам завершиться перед закрытием сессии бота
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=10)
+        await super().close()
+
+
+def build_web_app(dp: Dispatcher, bot: Bot, telegram_webhook: bool = True) -> web.Application:
+    """
+    Собирает aiohttp-приложение: вебхук Telegram (если telegram_webhook)
+    и вебхук Crypto Pay (если задан settings.crypto_pay_webhook_path).
+    """
+    app = web.Application()
+
+    if telegram_webhook:
+        handler = BoundedRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            max_concurrency=settings.webhook_max_concurrency,
+            acquire_timeout=settings.webhook_acquire_timeout,
+            secret_token=settings.webhook_secret.get_secret_value() if settings.webhook_secret else None,
+        )
+        handler.register(app, path=settings.webhook_path)
+        # Связывает запуск и остановку диспетчера с жизненным циклом приложения
+        setup_application(app, dp, bot=bot)
+
+    if settings.crypto_pay_webhook_path:
+        register_crypto_pay_webhook(app, dp, bot)
+    return app
+
+
+async def start_web_server(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.web_server_host, port=settings.web_server_port)
+    await site.start()
+    logging.info(f"Веб-сервер слушает {settings.web_server_host}:{settings.web_server_port}")
+    return runner
+
+
+async def on_webhook_startup(bot: Bot, dispatcher: Dispatcher) -> None:
+    if not settings.webhook_set_on_startup:
+        return
+    await bot.set_webhook(
+        url=f"{settings.webhook_base_url.rstrip('/')}{settings.webhook_path}",
+        secret_token=settings.webhook_secret.get_secret_value() if settings.webhook_secret else None,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        max_connections=settings.webhook_max_connections,
+        drop_pending_updates=True,
+    )
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Запускает веб-сервер и ждет его остановки."""
+    if not settings.webhook_base_url:
+        raise ValueError("Для режима webhook необходимо указать WEBHOOK_BASE_URL")
+
+    dp.startup.register(on_webhook_startup)
+    runner = await start_web_server(build_web_app(dp, bot))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_polling(dp: Dispatcher, bot: Bot) -> None:
+    """Long polling; если включен вебхук Crypto Pay, рядом поднимается веб-сервер только для него."""
+    runner = None
+    if settings.crypto_pay_webhook_path:
+        runner = await start_web_server(build_web_app(dp, bot, telegram_webhook=False))
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        if runner:
+            await runner.cleanup()